@@ -0,0 +1,54 @@
+#!/usr/bin/env python2.7
+"""
+Stress benchmark for FUDGGraph construction on synthetic annotations:
+random dependency trees (plus some CBBs over token spans) and plain chains,
+with edges listed in random order.
+
+  benchmarks/graph_build.py [-n REPEATS] [-s SIZES]
+"""
+from __future__ import print_function, division
+import os, sys, time, random
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '../scripts'))
+from graph import FUDGGraph
+
+def synthetic_graph(ntokens, shape='tree', ncbbs=0, seed=0):
+	'''FUDG JSON for a synthetic annotation of ntokens tokens.'''
+	rand = random.Random(seed)
+	tokens = ['t{}'.format(i) for i in range(ntokens)]
+	nodes = ['W({})'.format(t) for t in tokens]
+	edges = [['W($$)', nodes[0], None]]
+	for i in range(1, ntokens):
+		h = i-1 if shape=='chain' else rand.randrange(i)
+		edges.append([nodes[h], nodes[i], None])
+	for j in range(ncbbs):
+		start = rand.randrange(ntokens-2)
+		span = nodes[start:start+rand.randint(2,5)]
+		cbb = 'CBB{}'.format(j+1)
+		nodes.append(cbb)
+		edges.extend([cbb, n, 'unspec'] for n in span)
+	rand.shuffle(edges)
+	return {'tokens': tokens, 'nodes': nodes+['W($$)'], 'node_edges': edges, 'extra_node2words': {},
+			'node2words': dict([(n, [t]) for n,t in zip(nodes, tokens)]+[('W($$)', ['$$'])])}
+
+def best_time(f, repeats):
+	best = float('inf')
+	for _ in range(repeats):
+		t0 = time.time()
+		f()
+		best = min(best, time.time()-t0)
+	return best
+
+if __name__=='__main__':
+	sys.setrecursionlimit(10000)
+	p = OptionParser(usage="%prog [-n REPEATS] [-s SIZES]")
+	p.add_option('-n', dest='repeats', type='int', default=3, help="repetitions (best is reported)")
+	p.add_option('-s', dest='sizes', default='100,200,500', help="comma-separated token counts")
+	opts,args = p.parse_args()
+	for shape,ncbbs in (('tree',0), ('tree',20), ('chain',0)):
+		for n in map(int, opts.sizes.split(',')):
+			g = synthetic_graph(n, shape=shape, ncbbs=ncbbs)
+			t = best_time(lambda: FUDGGraph(g), opts.repeats)
+			print('{:5} tokens, {:5}, {:2} CBBs: {:8.2f} ms  ({:.1f} us/edge)'.format(n, shape, ncbbs, t*1000, t*1e6/len(g['node_edges'])))
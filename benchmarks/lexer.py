@@ -0,0 +1,86 @@
+#!/usr/bin/env python2.7
+"""
+Throughput of the regex lexer (gfl_parser.lex) versus the generated ANTLR
+psfLexer, on their own and as part of a GFLParserSession parse.
+
+  benchmarks/lexer.py [-n REPEATS] [-r COPIES] [files...]
+
+Defaults to every .anno file under anno/; -r repeats the annotations to get
+a longer run.
+"""
+from __future__ import print_function, division
+import os, sys, glob, time
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '../scripts'))
+sys.path.insert(0, os.path.join(here, '../parser'))
+import antlr3
+import view
+import gfl_parser
+from psfLexer import psfLexer
+
+def load(filenames):
+  items = []
+  for filename in filenames:
+    for tokens,code,anno,lines in view.iter_containers(filename):
+      if code: items.append((tokens, code.decode('utf8') if isinstance(code,str) else code))
+  return items
+
+LEXER = psfLexer(None)  # reused, as in GFLParserSession
+
+def antlr_lex(code):
+  lexer = LEXER
+  lexer.setCharStream(antlr3.ANTLRStringStream(code))
+  n = 0
+  while lexer.nextToken().type != antlr3.EOF:
+    n += 1
+  return n
+
+def regex_lex(code):
+  n = 0
+  for t in gfl_parser.lex(code):
+    n += 1
+  return n
+
+def best_time(f, xs, repeats):
+  best = float('inf')
+  for _ in range(repeats):
+    t0 = time.time()
+    for x in xs:
+      f(*x)
+    best = min(best, time.time()-t0)
+  return best
+
+if __name__=='__main__':
+  p = OptionParser(usage="%prog [-n REPEATS] [-r COPIES] [files...]")
+  p.add_option('-n', dest='repeats', type='int', default=5, help="repetitions (best is reported)")
+  p.add_option('-r', dest='copies', type='int', default=10, help="copies of the annotations")
+  opts,args = p.parse_args()
+  filenames = args or sorted(glob.glob(os.path.join(here, '../anno/*.anno'))+glob.glob(os.path.join(here, '../anno/*/*.anno')))
+  items = load(filenames)*opts.copies
+  codes = [(code,) for tokens,code in items]
+  chars = sum(len(code) for code, in codes)
+  # (psfLexer also returns the hidden whitespace, newline and comment tokens)
+  print('annotations: {}  characters: {}  parser tokens: {}'.format(len(codes), chars, sum(regex_lex(c) for c, in codes)))
+
+  t_antlr = best_time(antlr_lex, codes, opts.repeats)
+  t_regex = best_time(regex_lex, codes, opts.repeats)
+  print('lexing only')
+  print('  psfLexer:     {:8.0f} chars/sec'.format(chars/t_antlr))
+  print('  regex lexer:  {:8.0f} chars/sec'.format(chars/t_regex))
+  print('  speedup: {:.1f}x'.format(t_antlr/t_regex))
+
+  def parser(session):
+    def parse(tokens, code):
+      try:
+        session.parse(tokens, code)
+      except Exception:
+        pass
+    return parse
+  t_antlr = best_time(parser(gfl_parser.GFLParserSession()), items, opts.repeats)
+  t_regex = best_time(parser(gfl_parser.GFLParserSession(regex_lexer=True)), items, opts.repeats)
+  print('GFLParserSession.parse')
+  print('  psfLexer:     {:.3f} ms/annotation'.format(t_antlr/len(items)*1000))
+  print('  regex lexer:  {:.3f} ms/annotation'.format(t_regex/len(items)*1000))
+  print('  speedup: {:.2f}x'.format(t_antlr/t_regex))
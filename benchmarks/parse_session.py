@@ -0,0 +1,51 @@
+#!/usr/bin/env python2.7
+"""
+Per-sentence latency of gfl_parser.parse with a fresh ANTLR lexer/parser per
+annotation (the default) versus a reused GFLParserSession.
+
+  benchmarks/parse_session.py [-n REPEATS] [files...]
+
+Defaults to anno/tweets/*.anno.
+"""
+from __future__ import print_function, division
+import os, sys, glob, time
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '../scripts'))
+sys.path.insert(0, os.path.join(here, '../parser'))
+import view
+import gfl_parser
+
+def load(filenames):
+  items = []
+  for filename in filenames:
+    for tokens,code,anno in view.process_potentially_multifile(filename):
+      if code: items.append((tokens, code))
+  return items
+
+def time_per_sentence(items, parsers, repeats):
+  """best-of-N seconds per sentence for each parse function; runs are
+  interleaved so that warmup and GC noise hit both paths alike"""
+  best = [float('inf')]*len(parsers)
+  for _ in range(repeats):
+    for i,parse in enumerate(parsers):
+      t0 = time.time()
+      for tokens,code in items:
+        parse(tokens, code)
+      best[i] = min(best[i], time.time()-t0)
+  return [b/len(items) for b in best]
+
+if __name__=='__main__':
+  p = OptionParser(usage="%prog [-n REPEATS] [files...]")
+  p.add_option('-n', dest='repeats', type='int', default=5, help="repetitions (best is reported)")
+  opts,args = p.parse_args()
+  filenames = args or sorted(glob.glob(os.path.join(here, '../anno/tweets/*.anno')))
+  items = load(filenames)
+
+  session = gfl_parser.GFLParserSession()
+  fresh, reused = time_per_sentence(items, [gfl_parser.parse, session.parse], opts.repeats)
+  print('sentences: {}'.format(len(items)))
+  print('fresh lexer/parser:  {:.3f} ms/sentence'.format(fresh*1000))
+  print('GFLParserSession:    {:.3f} ms/sentence'.format(reused*1000))
+  print('speedup: {:.2f}x'.format(fresh/reused))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark suite for the GFL toolchain. Times each stage of the pipeline
+
+  parse      gfl_parser.parse (ANTLR) + to_json
+  parse_direct  gfl_parser.parse with the direct backend + to_json
+  peg        gflparser.parse (PEG, tuned grammar) + to_json
+  graph      FUDGGraph construction
+  simplify   simplify_coord, upward, downward
+  spanning   spanningtrees.spanning over the candidate-parent graphs
+  kirchhoff  kirchhoff.spanningtree, one sentence at a time
+  kirchhoff_batch  kirchhoff.spanningtree_counts over the whole corpus
+  merge      merge_annotations.merge of each annotation with a copy of itself
+
+on the bundled anno/ and cbbs/ corpora and on a synthetic corpus of
+random annotations. Each (corpus, stage) pair runs in a fresh process so that
+its peak memory can be reported; results are printed as one JSON object per
+line:
+
+  {"corpus": ..., "stage": ..., "items": ..., "errors": ..., "seconds": ...,
+   "items_per_sec": ..., "setup_rss_kb": ..., "peak_rss_kb": ...}
+
+where seconds is the best of -n runs over all items, setup_rss_kb is the
+process's peak resident memory after loading the corpus and running the
+earlier stages (untimed), and peak_rss_kb is its peak after the timed runs.
+
+  benchmarks/suite.py [-n REPEATS] [-c CORPORA] [-s STAGES] [-m SENTENCES] [-l TOKENS] [-o FILE]
+"""
+from __future__ import print_function, division
+import os, sys, glob, json, time, random, resource, subprocess, imp
+from optparse import OptionParser, SUPPRESS_HELP
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '../scripts'))
+sys.path.insert(0, os.path.join(here, '../parser'))
+
+CORPORA = ['anno', 'cbbs', 'synthetic']
+STAGES = ['parse', 'parse_direct', 'peg', 'graph', 'simplify', 'spanning', 'kirchhoff', 'kirchhoff_batch', 'merge']
+
+def synthetic_corpus(nsentences, ntokens, seed=0):
+	'''
+	(tokens, GFL code) for random annotations of ntokens tokens each:
+	a random dependency tree with about one token in eight left unattached,
+	plus a few bracketed CBBs over short token spans.
+	'''
+	rand = random.Random(seed)
+	items = []
+	for s in range(nsentences):
+		tokens = ['w{}'.format(i) for i in range(ntokens)]
+		lines = []
+		for i in range(1, ntokens):
+			if rand.random()>=1/8:
+				lines.append('{} < {}'.format(tokens[rand.randrange(i)], tokens[i]))
+		for j in range(ntokens//10):
+			start = rand.randrange(ntokens-2)
+			lines.append('({})'.format(' '.join(tokens[start:start+rand.randint(2,4)])))
+		items.append((tokens, '\n'.join(lines)))
+	return items
+
+def corpus(name, nsentences=1000, ntokens=20):
+	'''(tokens, GFL code) pairs for a named corpus.'''
+	if name=='synthetic':
+		return synthetic_corpus(nsentences, ntokens)
+	import view
+	items = []
+	for filename in sorted(glob.glob(os.path.join(here, '..', name, '*.anno'))+glob.glob(os.path.join(here, '..', name, '*', '*.anno'))):
+		for tokens,code,anno in view.process_potentially_multifile(filename) or []:
+			if code: items.append((tokens, code))
+	return items
+
+def attempt(f, xs):
+	'''Apply f to each of xs, returning the results that succeed.'''
+	results = []
+	for x in xs:
+		try:
+			results.append(f(x))
+		except Exception:
+			pass
+	return results
+
+def candidate_graph(a):
+	'''The candidate-parent graph of a simplified FUDGGraph, as in measures.promcom().'''
+	return {(p.name,n.name) for n in a.lexnodes for p in n.parentcandidates}
+
+def stage(name, items):
+	'''
+	Prepare the inputs for stage name from the corpus items (running the
+	stages it depends on). Returns a function that creates fresh inputs,
+	the function to time, and whether that function takes the whole list
+	of inputs at once rather than one input at a time.
+	'''
+	import gfl_parser
+	from graph import FUDGGraph, simplify_coord, upward, downward
+
+	def to_json(item):
+		return gfl_parser.parse(*item).to_json()
+	def simplified(J):
+		a = FUDGGraph(J)
+		simplify_coord(a)
+		upward(a)
+		downward(a)
+		return a
+
+	if name=='parse':
+		return (lambda: items), to_json, False
+	if name=='parse_direct':
+		return (lambda: items), (lambda item: gfl_parser.parse(*item, backend='direct').to_json()), False
+	if name=='peg':
+		peg = imp.load_source('gflparser', os.path.join(here, '../gflparser/parser.py'))
+		grammar = peg.load_grammar(tuned=True)
+		return (lambda: items), (lambda (tokens,code): peg.parse(code, grammar, tokens).to_json()), False
+
+	# JSON strings, decoded afresh for each run since later stages modify their input
+	jsons = map(json.dumps, attempt(to_json, items))
+	if name=='graph':
+		return (lambda: map(json.loads, jsons)), FUDGGraph, False
+	if name=='simplify':
+		def simplify(a):
+			simplify_coord(a)
+			upward(a)
+			downward(a)
+		return (lambda: attempt(FUDGGraph, map(json.loads, jsons))), simplify, False
+	if name=='merge':
+		from merge_annotations import merge
+		return (lambda: [[json.loads(J), json.loads(J)] for J in jsons]), merge, False
+
+	stgs = map(candidate_graph, attempt(simplified, map(json.loads, jsons)))
+	if name=='spanning':
+		from spanningtrees import spanning
+		return (lambda: stgs), (lambda stg: spanning(stg, '$$')), False
+	if name=='kirchhoff':
+		from kirchhoff import spanningtree
+		return (lambda: stgs), (lambda stg: spanningtree(stg, '$$')), False
+	if name=='kirchhoff_batch':
+		from kirchhoff import spanningtree_counts
+		return (lambda: stgs), (lambda stgs: spanningtree_counts(stgs, '$$')), True
+	raise ValueError('Unknown stage: '+name)
+
+def peak_rss_kb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run(corpusname, stagename, repeats, nsentences, ntokens):
+	'''Time one stage on one corpus in this process.'''
+	items = corpus(corpusname, nsentences, ntokens)
+	inputs, f, batched = stage(stagename, items)
+	setup_rss = peak_rss_kb()
+	best = float('inf')
+	for _ in range(repeats):
+		xs = inputs()
+		errors = 0
+		t0 = time.time()
+		for x in ([xs] if batched else xs):
+			try:
+				f(x)
+			except Exception:	# e.g. too many spanning trees, or a merge cycle
+				errors += 1
+		best = min(best, time.time()-t0)
+	return {'corpus': corpusname, 'stage': stagename, 'items': len(xs), 'errors': errors,
+			'seconds': best, 'items_per_sec': len(xs)/best if best else None,
+			'setup_rss_kb': setup_rss, 'peak_rss_kb': peak_rss_kb()}
+
+if __name__=='__main__':
+	sys.setrecursionlimit(10000)
+	p = OptionParser(usage="%prog [-n REPEATS] [-c CORPORA] [-s STAGES] [-m SENTENCES] [-l TOKENS] [-o FILE]")
+	p.add_option('-n', dest='repeats', type='int', default=3, help="repetitions (best is reported)")
+	p.add_option('-c', dest='corpora', default=','.join(CORPORA), help="comma-separated corpora")
+	p.add_option('-s', dest='stages', default=','.join(STAGES), help="comma-separated stages")
+	p.add_option('-m', dest='nsentences', type='int', default=1000, help="sentences in the synthetic corpus")
+	p.add_option('-l', dest='ntokens', type='int', default=20, help="tokens per synthetic sentence")
+	p.add_option('-o', dest='output', help="write results to this file instead of stdout")
+	p.add_option('--in-process', action='store_true', help="run every stage in this process (peak memory is then cumulative)")
+	p.add_option('--child', action='store_true', help=SUPPRESS_HELP)
+	opts,args = p.parse_args()
+
+	if opts.child:	# a single (corpus, stage) run: progress messages from the toolchain go to stderr, the result to stdout
+		corpusname, stagename = args
+		sys.stdout = sys.stderr
+		result = run(corpusname, stagename, opts.repeats, opts.nsentences, opts.ntokens)
+		print(json.dumps(result), file=sys.__stdout__)
+		sys.exit(0)
+
+	outF = open(opts.output, 'w') if opts.output else sys.stdout
+	for corpusname in opts.corpora.split(','):
+		for stagename in opts.stages.split(','):
+			if opts.in_process:
+				result = json.dumps(run(corpusname, stagename, opts.repeats, opts.nsentences, opts.ntokens))
+			else:
+				result = subprocess.check_output([sys.executable, __file__, '--child', '-n', str(opts.repeats),
+												  '-m', str(opts.nsentences), '-l', str(opts.ntokens), corpusname, stagename]).strip()
+			print(result, file=outF)
+			outF.flush()
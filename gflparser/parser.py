@@ -3,18 +3,30 @@
 '''
 PEG (parsing expression grammar)-based parser for GFL.
 Uses the Parsimonious library (https://github.com/erikrose/parsimonious).
-The grammar is loaded from the file gfl1.peg.
-When called directly, this script runs some cursory unit tests.
+The grammar is loaded from the file gfl1.peg, compiled once per process,
+and cached on disk (see load_grammar()); GFLPegParser parses with it into
+the gfl_parser.Parse structure, as the ANTLR-based parser does.
+When called directly, this script runs some cursory unit tests, or with
+--profile, reports the calls and time of each grammar rule (see profile()).
 
 @author: Nathan Schneider (nschneid@cs.cmu.edu)
 @since: 2013-03-08
 '''
-from __future__ import print_function
-import os, sys, re, fileinput
+from __future__ import print_function, division
+import os, sys, re, time, fileinput, hashlib, tempfile
+import cPickle as pickle
 from pprint import pprint
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from parsimonious.grammar import Grammar
+import parsimonious.expressions
+from parsimonious.exceptions import ParseError
+from parsimonious.grammar import Grammar, LazyReference
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../parser'))
+import gfl_parser
+
+GRAMMAR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gfl1.peg')
+ROOT = 'W($$)'  # the node for **, as in FUDG JSON
 
 class FixedDict(dict):
     '''Dict subclass which prevents reassignment to existing keys (unless the assigned value matches the stored value).'''
@@ -42,7 +54,7 @@ def walk(n):
     if t=='ALL':
         return [walk(c) for c in n.children]
     elif t in ('LINE','L','F','FD'):
-        assert len(n.children)==1
+        assert len(n.children)==1,('expected one child',t,n.text)
         x = walk(n.children[0])
         if t=='L' and len(x)>1:
             assert x[0]=='[' and x[-1]==']',repr(x)
@@ -58,9 +70,9 @@ def walk(n):
         return (t, x)
     elif t=='S':
         x = filter(None,[walk(c) for c in n.children])
-        assert x[0]=='{' and x[-1]=='}'
+        assert x[0]=='{' and x[-1]=='}',('set not in braces',x)
         x = x[1:-1]
-        assert len(x)==2
+        assert len(x)==2,('unexpected set contents',x)
         x = x[0][0]+[q[0] for q in x[1]]
         return (t, x)
     elif t in ('t','v'):
@@ -74,7 +86,7 @@ def walk(n):
             x = filter(None,[walk(c) for c in n.children])
             return [y for a in x for y in (a if not isinstance(a,(basestring,tuple)) else [a])]
     elif t in ('_backtick', '_'):
-        assert not n.children
+        assert not n.children,('whitespace with children',n.text)
         return None
     else:
         assert False,(t,n.text,n.children)
@@ -82,6 +94,213 @@ def walk(n):
 def clean(s):
     return re.sub('\n[ \t]+', ' ', re.sub(r'#.*','',s.replace('\t',' ').replace('`','_backtick')))
 
+def resolve_refs(grammar):
+    '''
+    Point any references to rules that Parsimonious left unresolved at the rules.
+    (Some versions resolve only one of several equal-looking subexpressions.)
+    '''
+    seen = set()
+    stack = list(grammar.values())
+    while stack:
+        expr = stack.pop()
+        if id(expr) in seen: continue
+        seen.add(id(expr))
+        members = getattr(expr, 'members', ())
+        if any(isinstance(m, LazyReference) for m in members):
+            expr.members = members = tuple(grammar[unicode(m)] if isinstance(m, LazyReference) else m for m in members)
+        stack.extend(members)
+    return grammar
+
+def compile_grammar(pegS):
+    '''The Grammar for the text of a .peg file.'''
+    return resolve_refs(Grammar(clean(pegS)))
+
+def make_grammar(rules, default):
+    '''The Grammar of the (name, expression) pairs rules, as Grammar._copy() does (bypassing Grammar.__init__).'''
+    grammar = Grammar.__new__(Grammar)
+    OrderedDict.__init__(grammar, rules)
+    grammar.default_rule = grammar[default]
+    return grammar
+
+def copy_grammar(grammar):
+    '''A deep copy of grammar (which copy.deepcopy() cannot make, as Grammar.__init__ expects the rules as text).'''
+    rules = pickle.loads(pickle.dumps(list(grammar.items()), pickle.HIGHEST_PROTOCOL))
+    return make_grammar(rules, grammar.default_rule.name)
+
+def expressions(grammar):
+    '''All the expressions in grammar: its rules and their subexpressions.'''
+    seen = OrderedDict()
+    stack = list(reversed(grammar.values()))
+    while stack:
+        expr = stack.pop()
+        if id(expr) in seen: continue
+        seen[id(expr)] = expr
+        stack.extend(reversed(getattr(expr, 'members', ())))
+    return seen.values()
+
+def unmemoized(expr):
+    '''A match_core() for expr that bypasses the packrat cache (recording failures for error reporting as match_core() does).'''
+    def match_core(text, pos, cache, error):
+        node = expr._uncached_match(text, pos, cache, error)
+        if node is None and pos >= error.pos and (expr.name or getattr(error.expr, 'name', None) is None):
+            error.expr = expr
+            error.pos = pos
+        return node
+    return match_core
+
+def tune_grammar(grammar):
+    '''
+    Tune a grammar (in place) for packrat parsing, without changing what it
+    matches or the parse trees it produces. Equal unnamed subexpressions are
+    merged, so a prefix that several rules share, such as the
+    ((S / d) _ ">" _)* of E, D, Fh and FDh, is matched only once at a
+    position, as if it were factored out into its own rule. Only the rules
+    and the merged subexpressions are then memoized: the other
+    subexpressions are only ever tried once at a position, so caching them
+    costs more than it saves.
+    '''
+    canonical = {}  # expression key -> shared expression
+    done = set()
+    nparents = defaultdict(int)
+    def share(expr):
+        if id(expr) in done:
+            return expr
+        done.add(id(expr))
+        members = getattr(expr, 'members', ())
+        if members:
+            expr.members = tuple(share(m) for m in members)
+            for m in expr.members:
+                nparents[id(m)] += 1
+        if expr.name:
+            return expr
+        regex = getattr(expr, 're', None)
+        key = (type(expr), getattr(expr, 'literal', None), regex and (regex.pattern, regex.flags),
+               getattr(expr, 'min', None), tuple(map(id, expr.members)) if members else ())
+        return canonical.setdefault(key, expr)
+    for name in grammar:
+        share(grammar[name])
+    for expr in expressions(grammar):
+        if not expr.name and nparents[id(expr)]<=1:
+            expr.match_core = unmemoized(expr)
+    return grammar
+
+_grammars = {}  # .peg file hash -> Grammar, for this process
+
+def private(path):
+    '''Whether path (or an open file descriptor) is owned by this user and not writable by anyone else.'''
+    st = os.fstat(path) if isinstance(path, int) else os.stat(path)
+    return st.st_uid==os.getuid() and not st.st_mode & 0o022
+
+def load_grammar(pegFP=GRAMMAR_FILE, cacheDir=None, tuned=False):
+    '''
+    The Grammar for a .peg file, compiled once per process and pickled to
+    cacheDir (by default, ~/.cache/gflparser), keyed on the file's hash,
+    for later processes. The pickle is recompiled if Parsimonious has changed
+    since. Since loading a pickle can run arbitrary code, the cache is only
+    used if it is private to the user (see private()). With tuned, a separate
+    copy of the grammar is returned, tuned by tune_grammar().
+    '''
+    with open(pegFP) as inF:
+        pegS = inF.read()
+    key = hashlib.sha1(pegS).hexdigest()
+    if tuned:
+        if (key, 'tuned') not in _grammars:
+            _grammars[key, 'tuned'] = tune_grammar(copy_grammar(load_grammar(pegFP, cacheDir)))
+        return _grammars[key, 'tuned']
+    if key in _grammars:
+        return _grammars[key]
+    stamp = os.path.getmtime(parsimonious.expressions.__file__)
+    cacheDir = cacheDir or os.path.join(os.path.expanduser('~'), '.cache', 'gflparser')
+    cacheFP = os.path.join(cacheDir, '{}.{}.pickle'.format(os.path.basename(pegFP), key))
+    grammar = None
+    try:
+        with open(cacheFP, 'rb') as inF:
+            if private(cacheDir) and private(inF.fileno()):
+                cachedStamp, rules, default = pickle.load(inF)
+                if cachedStamp==stamp:
+                    grammar = make_grammar(rules, default)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError, ValueError, KeyError, AttributeError, ImportError):
+        pass
+    if grammar is None:
+        grammar = compile_grammar(pegS)
+        try:
+            if not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir, 0o700)
+            if not private(cacheDir):
+                raise OSError('not a private directory: '+cacheDir)
+            # written under a temporary name, so that concurrent processes never read a partial pickle
+            fd, tmpFP = tempfile.mkstemp(dir=cacheDir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as outF:
+                pickle.dump((stamp, list(grammar.items()), grammar.default_rule.name), outF, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFP, cacheFP)
+        except (IOError, OSError):
+            pass    # the cache is only an optimization
+    _grammars[key] = grammar
+    return grammar
+
+def match(grammar, s):
+    '''
+    (tree, None) for the parse of s, or (None, position) if s does not parse,
+    where position is the furthest that any rule failed to match (or else
+    where the parse stopped short of the end).
+    '''
+    error = ParseError(s)
+    node = grammar.default_rule.match_core(s, 0, {}, error)
+    if node is not None and node.end==len(s):
+        return node, None
+    return None, max(error.pos, node.end if node is not None else 0)
+
+def profile(grammar, texts):
+    '''
+    Parse each of texts, counting for each rule of grammar (or, for unnamed
+    subexpressions, each type of expression) the calls, the calls not answered
+    from the packrat cache, and the time spent in it (excluding the rules and
+    subexpressions it calls). Returns {rule: [calls, uncached calls, seconds]}.
+    '''
+    stats = defaultdict(lambda: [0, 0, 0.0])
+    subtimes = [0.0]    # for each active expression, the time spent in the expressions it called
+    def instrument(expr, s):
+        match_core, uncached_match = expr.match_core, expr._uncached_match
+        def counted_match_core(text, pos, cache, error):
+            s[0] += 1
+            return match_core(text, pos, cache, error)
+        def timed_uncached_match(text, pos, cache, error):
+            s[1] += 1
+            subtimes.append(0.0)
+            t0 = time.time()
+            node = uncached_match(text, pos, cache, error)
+            t = time.time()-t0
+            s[2] += t-subtimes.pop()
+            subtimes[-1] += t
+            return node
+        expr.match_core, expr._uncached_match = counted_match_core, timed_uncached_match
+    exprs = expressions(grammar)
+    saved = [dict(expr.__dict__) for expr in exprs]
+    for expr in exprs:
+        instrument(expr, stats[expr.name or '({})'.format(type(expr).__name__)])
+    try:
+        for text in texts:
+            match(grammar, text)
+    finally:
+        for expr,d in zip(exprs, saved):
+            expr.__dict__.clear()
+            expr.__dict__.update(d)
+    return dict(stats)
+
+def print_profile(stats, outF=sys.stdout):
+    print('{:<14} {:>9} {:>9} {:>6} {:>9}'.format('rule', 'calls', 'uncached', 'hit%', 'self ms'), file=outF)
+    for rule,(calls,uncached,seconds) in sorted(stats.items(), key=lambda (r,s): -s[2]):
+        print('{:<14} {:>9} {:>9} {:>6.1f} {:>9.1f}'.format(rule, calls, uncached, 100*(calls-uncached)/max(calls,1), 1000*seconds), file=outF)
+
+def fudge_items(x):
+    '''The operands and operators of the simplified contents x of a fudge expression, in order, keeping bracketed expressions whole.'''
+    for c in x:
+        if isinstance(c,list) and not (c and c[0]=='(' and c[-1]==')'):
+            for y in fudge_items(c):
+                yield y
+        else:
+            yield c
+
 def analyze(tree):
     '''Analyze the simplified tree into meaningful GFL annotation graph structures (nodes and edges).'''
     n2w = FixedDict()
@@ -99,25 +318,27 @@ def analyze(tree):
                 n = n[1:-1]
         
         if '=' in n:  # anaphoric link
-            assert '**' not in n
+            assert '**' not in n,('** in an anaphoric link',n)
             itms = [traverse(c) for c in n[::2]]
             for a,b in zip(itms,itms[1:]):
                 anaph.add((a,b))
         elif '::' in n: # coordination
             v, a, j, b, c = n
-            assert a==b=='::'
-            assert v.startswith('$')
+            assert a==b=='::',('malformed coordination',n)
+            assert v.startswith('$'),('coordination node must be a $variable',v)
             j = traverse(j)
             c = traverse(c)
-            assert isinstance(j,set) and isinstance(c,set)
+            assert isinstance(j,set) and isinstance(c,set),('conjuncts and coordinators must be sets',n)
             coords.add((v,frozenset(j),frozenset(c)))
         elif n=='**':   # ** appearing as first item in a CBB
             return n
         elif isinstance(n,tuple):
             t, x = n
             if t=='L':  # lexical node
-                nname = 'W('+'_'.join(sorted(x))+')'
-                if len(x)>1: nname = 'M'+nname
+                if len(x)==1 and x[0].startswith('$'):  # variable (e.g. a coordination node)
+                    return x[0]
+                # named by the first occurrence, with its words in input order (as in gfl_parser)
+                nname = w2n.get(frozenset(x)) or ('M' if len(x)>1 else '')+'W('+'_'.join(x)+')'
                 w2n[frozenset(x)] = nname
                 n2w[nname] = set(x)
                 return nname
@@ -134,7 +355,7 @@ def analyze(tree):
                     
                     if c=='**':
                         curtype='**'
-                        assert prevtype==''
+                        assert prevtype=='',('** must follow a token or bracketed expression',x)
                     elif isinstance(c,tuple):
                         curtype = ''
                     elif isinstance(c,list):
@@ -157,51 +378,46 @@ def analyze(tree):
                 return {traverse(c) for c in x}
             elif t in ('F','FD'):
                 if isinstance(x[0],tuple) and x[0][0] in ('Fh','FDh'):
-                    assert len(x[0][1])==1
-                    assert '*' in x[0][1][0]
-                    rhs = x[0][1][0]
+                    assert len(x[0][1])==1,('unexpected fudge contents',x)
+                    rhs = list(fudge_items(x[0][1][0]))
+                    assert '*' in rhs,('no head marked with *',x)
                 else:
-                    assert len(x)>1
-                    assert '*' not in x
-                    rhs = x
+                    rhs = list(fudge_items(x))
+                    assert len(rhs)>1,('fudge expression with one item',x)
+                    assert '*' not in rhs,('unexpected * in fudge expression',x)
+                # split into the member expressions: operands joined by > and <, with any * or ** after the head
+                exprs = []
+                for i,c in enumerate(rhs):
+                    if (i>0 and c in ('>','<','*','**')) or (exprs and exprs[-1][-1] in ('>','<')):
+                        exprs[-1].append(c)
+                    else:
+                        exprs.append([c])
                 members = []
-                rightward = None
-                leftward = None
                 cbbhead = None
-                for i,c in enumerate(rhs):
-                        if c=='*':
-                            assert rightward is None
-                            assert cbbhead is None
-                            cbbhead = members[-1]
-                            continue
-                        if c[-1]=='>':
-                            assert len(c)==2
-                            c = traverse(c[0])
-                            if rightward is not None:
-                                deps.add((c,rightward))
-                            rightward = c
-                        elif c[0]=='<':
-                            assert len(c)==2
-                            c = traverse(c[1])
-                            assert leftward is not None
-                            deps.add((leftward,c))
-                            leftward = c
-                        else:
-                            c = traverse(c)
-                            if c=='**':
-                                if i==0:
-                                    cbbhead = c
-                                    members.append(c)
-                                else:
-                                    assert leftward is not None
-                                    assert leftward in members
-                                    deps.add(('**', leftward))
-                            else:
-                                members.append(c)
-                                leftward = c
-                        
-                
-                    
+                for e in exprs:
+                    if e==['**']:   # ** as the first item: the root heads the CBB
+                        cbbhead = '**'
+                        members.append('**')
+                        continue
+                    marks = [c for c in e if c in ('*','**')]
+                    e = [c for c in e if c not in ('*','**')]
+                    ops = e[1::2]
+                    k = ops.count('>')
+                    assert ops==['>']*k+['<']*(len(ops)-k),('> must precede the head and < follow it',e)
+                    items = [traverse(c) for c in e[::2]]
+                    h = items[k]
+                    assert not isinstance(h,set),('a set cannot be the head of a CBB member',e)
+                    # each > dependent attaches to the item after it, each < dependent to the item before it
+                    for hh,dd in zip(items[1:k+1], items[:k])+zip(items[k:], items[k+1:]):
+                        for d in (dd if isinstance(dd,set) else [dd]):
+                            deps.add((hh,d))
+                    members.append(h)
+                    if '*' in marks:
+                        assert cbbhead is None,('more than one head marked with * in a CBB',x)
+                        cbbhead = h
+                    if '**' in marks:
+                        deps.add(('**',h))
+
                 f = ww2cbb.setdefault(frozenset(members), 'CBB'+str(len(ww2cbb)+1))
                 if cbbhead is not None:
                     deps.add((f,cbbhead,'cbbhead'))
@@ -216,7 +432,7 @@ def analyze(tree):
             
             
             if len(n)==1:
-                assert '**' not in n
+                assert '**' not in n,('** on its own',n)
                 c = traverse(n)
                 return c
                 
@@ -253,7 +469,7 @@ def analyze(tree):
                     for d in (dd if isinstance(dd,set) else [dd]):
                         deps.add((h,d))
             if r:
-                assert set(r[::2])=={'<'}
+                assert set(r[::2])=={'<'},n
                 for h,dd in zip([c]+r[1::2],r[1::2]):
                     for d in (dd if isinstance(dd,set) else [dd]):
                         deps.add((h,d))
@@ -264,19 +480,87 @@ def analyze(tree):
     return n2w, w2n, ww2cbb, deps, anaph, coords
 
 
-def parse(gfl, grammar):
-    p = grammar.parse(gfl)
-    if p is None:
-        for ln in gfl.splitlines():
-            if grammar.parse(ln) is None:
-                raise GFLError('Cannot parse GFL line: '+ln)
-        assert False
-    # TODO: construct and return the parse data structure
+def to_parse(analysis, tokens):
+    '''The finalized gfl_parser.Parse for the output of analyze() on an annotation of tokens.'''
+    n2w, w2n, ww2cbb, deps, anaph, coords = analysis
+    node = lambda n: ROOT if n=='**' else n
+    p = gfl_parser.Parse()
+    p.tokens = [gfl_parser.unicodify(w) for w in tokens]
+    # as gfl_parser.consistency_check() does for the words referred to
+    gfl_parser.check_leaves(p.tokens, [(gfl_parser.TOKEN, w) for words in n2w.values() for w in words])
+    for n,words in n2w.items():
+        for w in words:
+            p.add_nodeword_edge(n, w)
+    for dep in deps:
+        p.add_node_edge(node(dep[0]), node(dep[1]), *dep[2:])
+        if '**' in dep[:2]:
+            p.add_nodeword_edge(ROOT, u'$$')
+    for a,b in anaph:
+        p.add_node_edge(a, b, 'Anaph')
+    for v,conjuncts,coordinators in coords:
+        for n in conjuncts:
+            p.add_node_edge(v, n, 'Conj')
+        for n in coordinators:
+            for w in p.node2words.get(n, ()):
+                p.add_nodeword_edge(v, w, 'Coord')
+    p.finalize()
+    return p
+
+def parse(gfl, grammar, tokens):
+    '''
+    The gfl_parser.Parse of the GFL annotation of tokens. Raises GFLError
+    (with the line and column of the PEG parse failure) if it does not parse,
+    or if the annotation is invalid.
+    '''
+    gfl = gfl_parser.unicodify(gfl)
+    tree, pos = match(grammar, gfl)
+    if tree is None:
+        start = gfl.rfind('\n', 0, pos)+1
+        end = gfl.find('\n', pos)
+        ln = gfl[start:end if end>=0 else len(gfl)]
+        raise GFLError('Cannot parse GFL line {}, column {}: {}'.format(gfl.count('\n', 0, pos)+1, pos-start+1, ln.encode('utf-8')))
+    try:
+        return to_parse(analyze(walk(tree)), tokens)
+    except (AssertionError, KeyError, gfl_parser.ParseError) as ex:
+        raise GFLError('Invalid GFL: {}'.format(ex or repr(ex)))
+
+class GFLPegParser(object):
+    '''Parses GFL annotations with a grammar loaded once (see load_grammar()), by default tuned.'''
+    def __init__(self, pegFP=GRAMMAR_FILE, cacheDir=None, tuned=True):
+        self.grammar = load_grammar(pegFP, cacheDir, tuned)
+
+    def parse(self, gfl, tokens):
+        return parse(gfl, self.grammar, tokens)
+
+    def parse_many(self, items):
+        '''Parse each (gfl, tokens) of items, yielding its Parse, or the GFLError for one that does not parse.'''
+        for gfl,tokens in items:
+            try:
+                yield self.parse(gfl, tokens)
+            except GFLError as ex:
+                yield ex
 
 
 def test(inFP):
-    with open(inFP) as inF:
-        grammar = Grammar(clean(inF.read()))
+    cacheDir = tempfile.mkdtemp()
+    parser = GFLPegParser(inFP, cacheDir, tuned=False)
+    grammar = parser.grammar
+    assert load_grammar(inFP, cacheDir) is grammar
+    _grammars.clear()
+    assert load_grammar(inFP, cacheDir) is not grammar  # from the pickle
+    # a pickle in a directory that others can write to is never loaded
+    cacheFP, = [os.path.join(cacheDir, f) for f in os.listdir(cacheDir)]
+    planted = compile_grammar('ALL = "planted"')
+    with open(cacheFP, 'wb') as outF:
+        pickle.dump((os.path.getmtime(parsimonious.expressions.__file__), list(planted.items()), 'ALL'), outF, pickle.HIGHEST_PROTOCOL)
+    os.chmod(cacheDir, 0o777)
+    _grammars.clear()
+    assert 'LINE' in load_grammar(inFP, cacheDir)
+    os.chmod(cacheDir, 0o700)
+    _grammars.clear()
+    assert 'LINE' not in load_grammar(inFP, cacheDir)    # (as it is from a private directory)
+    os.remove(cacheFP)
+    _grammars.clear()
 
     good_inputs = ['{the quick brown} > fox > jumps < over < ({the lazy} > dog)', 
                    'They > conspired < to < defenestrate < themselves\n(conspired* to defenestrate on < Tuesday)',
@@ -310,9 +594,10 @@ def test(inFP):
                   'They > conspired* < to < defenestrate < themselves\n(conspired* to defenestrate on < Tuesday)',
                   'big > **', '{** happy} > days', '(my big** fat Greek wedding*)', 'big** > day', 
                   'hi :: there', ':-)', '(-:', '(0_0)~1', '*_*', ') (']
+    words = lambda x: sorted({w for ws in analyze(walk(grammar.parse(x)))[0].values() for w in ws})
     for x in bad_inputs:
         try:
-            parse(x, grammar)
+            parse(x, grammar, x.split())
             assert False
         except GFLError as ex:
             print(ex)
@@ -321,9 +606,111 @@ def test(inFP):
         assert p is not None
         print(x)
         pprint(analyze(walk(p)))
+        pprint(parse(x, grammar, words(x)).to_json())
+    items = [(x, words(x)) for x in good_inputs]+[(x, x.split()) for x in bad_inputs]
+    results = list(GFLPegParser(inFP, cacheDir).parse_many(items))
+    assert [p.to_json() for p in results[:len(good_inputs)]]==[parse(x, grammar, tokens).to_json() for x,tokens in items[:len(good_inputs)]]
+    assert all(isinstance(ex, GFLError) for ex in results[len(good_inputs):])
+
+    p = parse('a (** b c**)', grammar, ['a', 'b', 'c'])
+    assert p.node2words['W($$)']=={'$$'} and ('W($$)', 'W(c)', None) in p.node_edges
+    assert 'MW(we_are)' in parse('[we are] < here\n[are we] < here', grammar, ['are', 'here', 'we']).nodes
+    try:
+        parse('a > b\nc < < d', grammar, ['a', 'b', 'c', 'd'])
+        assert False
+    except GFLError as ex:   # located by the one parse
+        assert str(ex).startswith('Cannot parse GFL line 2, column '),ex
+    try:
+        parse('a > b', grammar, ['a'])
+        assert False
+    except GFLError as ex:
+        assert 'not in original text' in str(ex),ex
+
+    # > and < attachments inside CBBs, as in gfl_parser
+    toks = ['a', 'b', 'c', 'd', 'x']
+    for x in ['(a > b c)', '(c a > b)', '(a > b* c)', '(x > a > b* c < d)', '(c (a > b)*)', '(d < (a > b c))']:
+        assert normalized(parse(x, grammar, toks).to_json())==normalized(gfl_parser.parse(toks, x).to_json()),x
+    assert ('W(b)', 'W(a)', None) in parse('(a > b c)', grammar, toks).node_edges
+
+    # the same graphs as gfl_parser for the anno/ annotations that the grammar accepts, except where
+    # a token of gfl1.peg includes an operator character (our>) or gfl_parser sees a // comment
+    for tokens,code in anno_items([os.path.join(os.path.dirname(os.path.abspath(__file__)), '../anno')]):
+        if match(grammar, code)[0] is None: continue
+        try:
+            p = parse(code, grammar, tokens)
+        except GFLError as ex:
+            assert 'not in original text' in str(ex),(code,ex)
+            continue
+        assert normalized(p.to_json())==normalized(gfl_parser.parse(tokens, code).to_json()),code
+
+    # the tuned grammar matches (and fails) exactly as the grammar does
+    tuned = load_grammar(inFP, cacheDir, tuned=True)
+    assert tuned is not grammar and load_grammar(inFP, cacheDir, tuned=True) is tuned
+    assert len(expressions(tuned))<len(expressions(grammar))
+    def result(g, x):
+        tree, pos = match(g, x)
+        return walk(tree) if tree is not None else pos
+    texts = good_inputs+bad_inputs+anno_codes([os.path.join(os.path.dirname(os.path.abspath(__file__)), '../anno')])
+    assert [result(tuned, x) for x in texts]==[result(grammar, x) for x in texts]
+    assert [p.to_json() for p in GFLPegParser(inFP, cacheDir).parse_many(items[:len(good_inputs)])]==[p.to_json() for p in results[:len(good_inputs)]]
+
+    # profiling leaves the grammar as it was; parsing a long line takes linear work
+    stats = profile(tuned, good_inputs)
+    assert stats['ALL'][:2]==[len(good_inputs), len(good_inputs)] and stats['LINE'][1]>len(good_inputs)
+    assert all('match_core' not in expr.__dict__ or expr.match_core.__name__=='match_core' for expr in expressions(tuned))
+    def thread(n):
+        forms = ['({} > {}* {})', '[{} {} {}]', '({{{} {}}} > {})', '{} < {} < {}']
+        return ' < '.join(forms[i%4].format(*('w{}'.format(j) for j in range(3*i, 3*i+3))) for i in range(n//3))
+    work = [sum(s[1] for s in profile(tuned, [thread(n)]).values()) for n in (100, 200, 400)]
+    assert work[1]<=2.1*work[0] and work[2]<=2.1*work[1],work
+    import shutil
+    shutil.rmtree(cacheDir)
+
+def normalized(parseJ):
+    '''A parse's JSON with its CBBs named by their members and heads, for comparing parses that number CBBs differently.'''
+    members = defaultdict(list)
+    for h,c,l in parseJ['node_edges']:
+        if h.startswith('CBB') and l in ('unspec', 'cbbhead'):
+            members[h].append((c,l))
+    names = {}
+    def name(n):
+        if n.startswith('CBB') and n not in names:
+            names[n] = 'CBB'+repr(sorted((name(c),l) for c,l in members[n]))
+        return names.get(n, n)
+    J = dict(parseJ)
+    J['nodes'] = sorted(map(name, parseJ['nodes']))
+    J['node_edges'] = sorted((name(h),name(c),l) for h,c,l in parseJ['node_edges'])
+    for k in ('node2words', 'extra_node2words'):
+        J[k] = {name(n):sorted(ws) for n,ws in parseJ[k].items()}
+    return J
+
+def anno_codes(paths):
+    '''The GFL annotations in the .anno files under paths (files or directories).'''
+    return [code for tokens,code in anno_items(paths)]
+
+def anno_items(paths):
+    '''(tokens, GFL code) for the annotations in the .anno files under paths (files or directories).'''
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../scripts'))
+    import view
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, names in os.walk(path):
+                filenames.extend(os.path.join(dirpath, name) for name in names if name.endswith('.anno'))
+        else:
+            filenames.append(path)
+    return [(tokens, code) for filename in sorted(filenames) for tokens,code,anno in view.process_potentially_multifile(filename) or [] if code]
 
 if __name__=='__main__':
-    test('gfl1.peg')
+    from optparse import OptionParser
+    p = OptionParser(usage="%prog\n       %prog --profile [-t] [file|dir...]")
+    p.add_option('--profile', action='store_true', help="profile the rules on parsing the annotations in the .anno files given (default: anno/)")
+    p.add_option('-t', '--tuned', action='store_true', help="profile the tuned grammar (see tune_grammar())")
+    opts,args = p.parse_args()
+    if opts.profile:
+        codes = anno_codes(args or [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../anno')])
+        print_profile(profile(load_grammar(tuned=opts.tuned), codes))
+    else:
+        test('gfl1.peg')
 
-# TODO: error-checking, e.g. at most one cbbhead per CBB, all tokens are unambiguous in input, etc.
-# TODO: when naming MW nodes, use token order in input
+# TODO: error-checking, e.g. at most one cbbhead per CBB, etc.
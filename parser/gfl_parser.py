@@ -12,7 +12,9 @@ HEAD < {CHILD CHILD}
 CHILD > HEAD
 """
 
-import sys,itertools,re,string
+import sys,os,itertools,re,string,hashlib,tempfile
+import cPickle as pickle
+from array import array
 from collections import defaultdict
 try:
   import ujson as json
@@ -172,8 +174,15 @@ class Parse:
 
     
   def to_json(self, numberize=False):
+    """
+    With numberize, nodes and words are referred to by integer ids: a node by
+    its position in d['nodes'] (node2id), a word by its position in
+    d['tokens'] (word2id). node2words and extra_node2words are then keyed by
+    node id, and node_edges are [head id, child id, label].
+    """
     assert self.is_finalized
-    assert not numberize, "numberization not implemented yet"
+    if numberize:
+      return self.numberize().to_json(numberize=True)
     d = {}
     d['node2words'] = {k:list(v) for k,v in self.node2words.items()}
     d['extra_node2words'] = {k:list(v) for k,v in self.extra_node2words.items()}
@@ -185,8 +194,18 @@ class Parse:
 
     return d
 
+  def numberize(self, vocab=None):
+    """
+    Compact copy of this Parse. Pass the same Vocab for every parse of a
+    corpus so that they share their strings.
+    """
+    assert self.is_finalized
+    return NumberizedParse(self, Vocab() if vocab is None else vocab)
+
   @staticmethod
   def from_json(obj):
+    if is_numberized_json(obj):
+      obj = NumberizedParse.from_json(obj, Vocab()).to_json()
     p = Parse()
     p.tokens = obj['tokens']
     p.node2words = obj['node2words']
@@ -204,6 +223,112 @@ class Parse:
     s += "\n"
     return s
 
+class Vocab:
+  """Interns strings (tokens, node names and labels) to integer ids."""
+  def __init__(self):
+    self.ids = {}
+    self.strings = []
+
+  def intern(self, s):
+    if s not in self.ids:
+      self.ids[s] = len(self.strings)
+      self.strings.append(s)
+    return self.ids[s]
+
+  def __len__(self):
+    return len(self.strings)
+
+class NumberizedParse(object):
+  """
+  Compact, read-only form of a finalized Parse, for holding many parses in
+  memory. Tokens, node names and labels are interned in a Vocab; words are
+  referred to by position in tokens and nodes by position in nodes (sorted
+  by name), as in Parse.word2id and Parse.node2id. Edges and node-word
+  edges are stored as parallel array('i') columns, with -1 for no label.
+  """
+  __slots__ = ('vocab', 'tokens', 'nodes', 'edge_heads', 'edge_children', 'edge_labels',
+               'node2words_nodes', 'node2words_words',
+               'extra_node2words_nodes', 'extra_node2words_words', 'extra_node2words_labels')
+
+  def __init__(self, parse=None, vocab=None):
+    self.vocab = vocab
+    for column in self.__slots__[1:]:
+      setattr(self, column, array('i'))
+    if parse is None: return
+
+    intern = vocab.intern
+    label_id = lambda label: -1 if label is None else intern(label)
+    self.tokens.extend(intern(w) for w in parse.tokens)
+    self.nodes.extend(intern(n) for n in sorted(parse.nodes))
+    for h,c,label in sorted(parse.node_edges):
+      self.edge_heads.append(parse.node2id[h])
+      self.edge_children.append(parse.node2id[c])
+      self.edge_labels.append(label_id(label))
+    for n,words in sorted(parse.node2words.items()):
+      for w in sorted(parse.word2id[w] for w in words):
+        self.node2words_nodes.append(parse.node2id[n])
+        self.node2words_words.append(w)
+    for n,pairs in sorted(parse.extra_node2words.items()):
+      for w,label in sorted((parse.word2id[w],label) for w,label in pairs):
+        self.extra_node2words_nodes.append(parse.node2id[n])
+        self.extra_node2words_words.append(w)
+        self.extra_node2words_labels.append(label_id(label))
+
+  def to_json(self, numberize=False):
+    """Same as Parse.to_json()."""
+    strings = self.vocab.strings
+    label = lambda i: None if i<0 else strings[i]
+    if numberize:
+      node = word = lambda i: i
+    else:
+      node = lambda i: strings[self.nodes[i]]
+      word = lambda i: strings[self.tokens[i]]
+    d = {}
+    d['node2words'] = defaultdict(list)
+    for n,w in itertools.izip(self.node2words_nodes, self.node2words_words):
+      d['node2words'][node(n)].append(word(w))
+    d['extra_node2words'] = defaultdict(list)
+    for n,w,l in itertools.izip(self.extra_node2words_nodes, self.extra_node2words_words, self.extra_node2words_labels):
+      d['extra_node2words'][node(n)].append((word(w),label(l)))
+    d['node2words'] = dict(d['node2words'])
+    d['extra_node2words'] = dict(d['extra_node2words'])
+    d['node_edges'] = sorted((node(h),node(c),label(l)) for h,c,l in itertools.izip(self.edge_heads, self.edge_children, self.edge_labels))
+    d['tokens'] = [strings[w] for w in self.tokens]
+    d['nodes'] = [strings[n] for n in self.nodes]
+    return d
+
+  @staticmethod
+  def from_json(obj, vocab):
+    """From the output of to_json(), numberized or not."""
+    if not is_numberized_json(obj):
+      return Parse.from_json(obj).numberize(vocab)
+    p = NumberizedParse(vocab=vocab)
+    intern = vocab.intern
+    label_id = lambda label: -1 if label is None else intern(label)
+    p.tokens.extend(intern(w) for w in obj['tokens'])
+    p.nodes.extend(intern(n) for n in obj['nodes'])
+    for h,c,label in obj['node_edges']:
+      p.edge_heads.append(h)
+      p.edge_children.append(c)
+      p.edge_labels.append(label_id(label))
+    # JSON object keys are strings
+    for n,words in sorted((int(n),words) for n,words in obj['node2words'].items()):
+      for w in words:
+        p.node2words_nodes.append(n)
+        p.node2words_words.append(w)
+    for n,pairs in sorted((int(n),pairs) for n,pairs in obj.get('extra_node2words',{}).items()):
+      for w,label in pairs:
+        p.extra_node2words_nodes.append(n)
+        p.extra_node2words_words.append(w)
+        p.extra_node2words_labels.append(label_id(label))
+    return p
+
+def is_numberized_json(obj):
+  """Whether obj is the output of to_json(numberize=True) (possibly after a JSON round trip)."""
+  if obj['node_edges']:
+    return isinstance(obj['node_edges'][0][0], (int,long))
+  return any(words and isinstance(words[0], (int,long)) for words in obj['node2words'].values())
+
 def clean_empty_entries(dct):
   """intended for a dictionary where values are sets or lists."""
   for k in list(dct.keys()):
@@ -216,15 +341,35 @@ def unicodify(s, encoding='utf8', *args):
   if isinstance(s,str): return s.decode(encoding, *args)
   return unicode(s)
 
-def parse(text_tokens, psf_code, check_semantics=False):
+def parse(text_tokens, psf_code, check_semantics=False, session=None, regex_lexer=False, backend='antlr'):
   """ 
   text_tokens is a list of strings: the allowable tokens.
   psf_code is a string, the literal GFL code
+  session is an optional GFLParserSession to reuse the ANTLR lexer/parser
+  regex_lexer selects lex() instead of psfLexer (for a session, set it there)
+  backend is 'antlr', or 'direct' for DirectParser (falling back to 'antlr' where it cannot parse the code)
 
   returns the semantic Parse
   """
   text_tokens = [unicodify(x) for x in text_tokens]
-  parsetree = antlr_parse(psf_code)
+  if backend == 'direct':
+    try:
+      p = DirectParser(psf_code).parse(text_tokens)
+    except Unparsed:
+      p = antlr_process(text_tokens, psf_code, session, regex_lexer)
+  elif backend == 'antlr':
+    p = antlr_process(text_tokens, psf_code, session, regex_lexer)
+  else:
+    raise ValueError("unknown parser backend: %s" % backend)
+
+  p.finalize()
+  if check_semantics:
+    graph_semantics_check(p)
+  return p
+
+def antlr_process(text_tokens, psf_code, session, regex_lexer):
+  """The Parse (not yet finalized) from walking the ANTLR tree"""
+  parsetree = session.antlr_parse(psf_code) if session else antlr_parse(psf_code, regex_lexer=regex_lexer)
   tree = parsetree.tree
   all_leaves = list(leaves(tree))
   if not all_leaves:
@@ -286,9 +431,6 @@ def parse(text_tokens, psf_code, check_semantics=False):
     else:
       assert False, "bad type %s %s" % (typ, TypeNames[typ])
 
-  p.finalize()
-  if check_semantics:
-    graph_semantics_check(p)
   return p
 
 def show(antlr_node):
@@ -420,20 +562,23 @@ def leaves(antlr_node):
 
 def consistency_check(text_tokens, tree):
   """ Do checks on the tokens and AST """
+  check_leaves(text_tokens, [(leaf.getType(), leaf.token.text) for leaf in leaves(tree)])
+
+def check_leaves(text_tokens, leaves):
+  """ Do checks on the tokens and the (type, text) leaves of the AST """
   # References check
   alltoks = set(text_tokens)
-  for leaf in leaves(tree):
-    if is_node(leaf): continue
-    if leaf.getType()==HEAD: continue
-    if leaf.token.text not in alltoks:
-      raise ParseError("Word %s not in original text" % repr(leaf.token.text))
+  for typ,t in leaves:
+    if t.startswith('$'): continue
+    if typ==HEAD: continue
+    if t not in alltoks:
+      raise ParseError("Word %s not in original text" % repr(t))
       
   # Duplicates check
   counts = defaultdict(int)
   for t in text_tokens: counts[t] += 1
   duplicated_tokens = set(k for k in counts if counts[k] > 1)
-  for leaf in leaves(tree):    
-    t = leaf.token.text
+  for typ,t in leaves:
     if t in duplicated_tokens:
       raise ParseError("Reference to a duplicate token: %s" % t)
   
@@ -449,10 +594,90 @@ def graph_semantics_check(parse):
       raise InvalidGraph("Violates tree constraint: node {} has {} outbound edges: {}".format(
         repr(n), len(outbounds), repr(outbounds)))
 
-def antlr_parse(code):
+########## regex lexer
+
+# A single-pass alternative to psfLexer (see psf.g): one compiled regex whose
+# alternatives are ordered so that the first to match gives the token
+# psfLexer would produce, i.e. the longest match, with ties going to the rule
+# listed first in the grammar (and TOKEN last).
+
+_NL = u'\n\r\u2028\u2029'
+_WS = u'\t\x0b\x0c \xa0\u1680\u2000-\u200b\u202f\u3000'
+_NOT_TOKEN = u'(?![^%s%s*}\\])\\]{(\\[><])' % (_NL, _WS)  # not followed by a TOKEN character
+
+def _tag(*words):
+  # Without whitespace after the backslash, a tag followed by more TOKEN
+  # characters is a TOKEN.  After whitespace, the tag must be complete: like
+  # psfLexer, reject "\ vo" rather than reading "\ v" followed by "o".
+  words = sorted(words, key=len, reverse=True)
+  def complete(w):
+    longer = [x for x in words if len(x) > len(w) and x.startswith(w)]
+    return w + (u'(?!%s)' % longer[0][len(w)] if longer else u'')
+  return u'\\\\(?:[%s]+(?:%s)|(?:%s)%s)' % (_WS, u'|'.join(map(complete, words)), u'|'.join(words), _NOT_TOKEN)
+
+LEXER_RE = re.compile(u'|'.join(u'(?P<%s>%s)' % pair for pair in [
+  ('NEWLINE', u'[%s]+' % _NL),
+  ('WS', u'[%s]+' % _WS),
+  ('COMMENT', u'//[^%s]*' % _NL),
+  ('RARROW', u'-*>'),
+  ('LARROW', u'<-*'),
+  ('DCOLON', u'::' + _NOT_TOKEN),
+  ('EQ', u'=' + _NOT_TOKEN),
+  ('DOLLARTOKEN', u'\\$[a-zA-Z_][a-zA-Z_0-9]*' + _NOT_TOKEN),
+  ('VOCTAG', _tag(u'V', u'v', u'VOC', u'voc', u'VOCATIVE', u'vocative')),
+  ('INTTAG', _tag(u'I', u'i', u'INT', u'int', u'INTERJECTION', u'interjection')),
+  ('ERROR', u'\\\\(?=[%s])' % _WS),
+  ('HEAD', u'\\*'), ('LSB', u'\\['), ('RSB', u'\\]'), ('LCB', u'\\{'), ('RCB', u'\\}'), ('LRB', u'\\('), ('RRB', u'\\)'),
+  ('TOKEN', u'[^%s%s*}\\])\\]{(\\[><]+' % (_NL, _WS)),
+  ]), re.UNICODE)
+
+HIDDEN_TYPES = ('NEWLINE', 'WS', 'COMMENT')
+
+def lex(code):
+  """
+  Yield (type, text, start, line, column) tuples for the tokens of the GFL
+  code (a unicode string) that the parser sees, as psfLexer would produce
+  them; type is a psfLexer token type, and line and column are counted as
+  by ANTLR (from 1 and 0).  Raises ParseError where psfLexer reports an error.
+  """
+  types = psfLexer_module.__dict__
+  line, linestart = 1, 0
+  pos, n = 0, len(code)
+  match = LEXER_RE.match
+  while pos < n:
+    m = match(code, pos)
+    kind = m.lastgroup
+    end = m.end()
+    if kind == 'NEWLINE':
+      nl = code.rfind(u'\n', pos, end)
+      if nl >= 0:
+        line += code.count(u'\n', pos, end)
+        linestart = nl+1
+    elif kind == 'ERROR':
+      raise ParseError("line %d:%d incomplete vocative or interjection tag" % (line, pos-linestart))
+    elif kind not in HIDDEN_TYPES:
+      yield types[kind], m.group(), pos, line, pos-linestart
+    pos = end
+
+class RegexTokenSource(antlr3.TokenSource):
+  """ANTLR token source over lex(), for use in place of psfLexer."""
+  def __init__(self, code):
+    self.tokens = lex(code)
+
+  def nextToken(self):
+    for typ, text, start, line, column in self.tokens:
+      t = antlr3.CommonToken(type=typ, text=text, start=start, stop=start+len(text)-1)
+      t.line, t.charPositionInLine = line, column
+      return t
+    return antlr3.EOF_TOKEN
+
+def antlr_parse(code, regex_lexer=False):
+  """The ANTLR parse of the GFL code, lexed by psfLexer or, with regex_lexer, by lex()"""
   if isinstance(code,str): code = code.decode('utf8')
-  char_stream = antlr3.ANTLRStringStream(code)
-  lexer = psfLexer(char_stream)
+  if regex_lexer:
+    lexer = RegexTokenSource(code)
+  else:
+    lexer = psfLexer(antlr3.ANTLRStringStream(code))
   tokens = antlr3.CommonTokenStream(lexer)
   parser = psfParser(tokens)
   parsetree = parser.annotate()
@@ -460,6 +685,399 @@ def antlr_parse(code):
     raise ParseError("failed to parse")
   return parsetree
 
+class GFLParserSession(object):
+  """
+  One psfLexer/CommonTokenStream/psfParser (with their DFAs) kept alive and
+  reset onto each new annotation, instead of rebuilding them per call as
+  antlr_parse() does.  Use this when converting many annotations:
+
+    session = GFLParserSession()
+    for tokens,code in ...:
+      p = session.parse(tokens, code)
+
+  Not thread-safe; use one session per thread/process.  With regex_lexer,
+  annotations are lexed by lex() instead of psfLexer.  With backend='direct',
+  they are parsed by DirectParser, and the session is only used for the code
+  that falls back to psfParser.
+  """
+  def __init__(self, regex_lexer=False, backend='antlr'):
+    self.regex_lexer = regex_lexer
+    self.backend = backend
+    self.lexer = psfLexer(None)
+    self.token_stream = antlr3.CommonTokenStream(self.lexer)
+    self.parser = psfParser(self.token_stream)
+
+  def antlr_parse(self, code):
+    if isinstance(code,str): code = code.decode('utf8')
+    if self.regex_lexer:
+      self.token_stream.setTokenSource(RegexTokenSource(code))
+    else:
+      self.lexer.setCharStream(antlr3.ANTLRStringStream(code))
+      self.token_stream.setTokenSource(self.lexer)
+    self.parser.setTokenStream(self.token_stream)
+    # a previous parse that raised may have left rule follow sets behind
+    del self.parser.following[:]
+    parsetree = self.parser.annotate()
+    if parsetree.tree is None:
+      raise ParseError("failed to parse")
+    return parsetree
+
+  def parse(self, text_tokens, psf_code, check_semantics=False):
+    return parse(text_tokens, psf_code, check_semantics=check_semantics, session=self, backend=self.backend)
+
+########## direct parser
+
+ATOM_START = frozenset([TOKEN, DOLLARTOKEN, LSB, LCB, LRB])  # also the tokens that can start a line
+LINE_FOLLOW = frozenset([EOF, LARROW, RARROW, DOLLARTOKEN, LRB, TOKEN, LCB, LSB])  # after a line's first narrow
+
+class Unparsed(Exception):
+  """Code that DirectParser leaves to the ANTLR backend (see DirectParser)"""
+
+class DirectParser(object):
+  """
+  Recursive-descent parser for psf.g over lex() tokens, adding nodes and
+  edges to a Parse as it goes rather than building an AST for
+  process_chain() to walk.  The result is the Parse that process_chain()
+  builds: at the end, CBBs are renumbered and node2words is refilled in its
+  order (e.g. the head of "a > b" before the child), so that even the key
+  order of to_json()'s dicts is the same.
+
+  Code that psfParser reports an error in (and recovers from, often by
+  dropping tokens), or that process_chain() asserts on, raises Unparsed
+  instead, as does a [b a] phrase over the words of an earlier [a b], whose
+  node's name depends on process_chain()'s order; parse() then falls back to
+  the ANTLR backend.  Like psfParser, parsing stops silently at a token that
+  cannot start a line.
+  """
+  def __init__(self, code):
+    if isinstance(code,str): code = code.decode('utf8')
+    try:
+      tokens = list(lex(code))
+    except ParseError:  # psfLexer reports these and carries on
+      raise Unparsed()
+    self.types = [t[0] for t in tokens] + [EOF]
+    self.texts = [t[1] for t in tokens] + [None]
+    self.i = 0
+
+  def parse(self, text_tokens):
+    self.p = p = Parse()
+    p.tokens = text_tokens[:]
+    self.leaves = []    # (type, text) as leaves() would find them
+    self.cbbs = []      # (process order key, CBB node)
+    self.first = {}     # node2words key -> process order key
+    self.added = []     # node2words keys in the order they were added
+    nlines = 0
+    while self.types[self.i] in ATOM_START:
+      self.line((nlines,))
+      nlines += 1
+    if not nlines:  # psfParser's tree is then an empty nil node
+      raise ParseError("no leaves in AST")
+    check_leaves(text_tokens, self.leaves)
+    self.reorder()
+    return p
+
+  def expect(self, typ):
+    if self.types[self.i] != typ:
+      raise Unparsed()
+    self.i += 1
+
+  def touch(self, key, node):
+    """Note that process_chain() would look up node in node2words at key"""
+    first = self.first.get(node)
+    if first is None:
+      self.first[node] = key
+      self.added.append(node)
+    elif key < first:
+      self.first[node] = key
+
+  def leaf(self):
+    i = self.i
+    self.leaves.append((self.types[i], self.texts[i]))
+    self.i += 1
+    return self.texts[i]
+
+  # Each rule returns the head nodes and the root type of its ANTLR subtree.
+  # key orders the rule's subtree by when process_chain() reaches it.
+
+  def line(self, key):
+    # predicted as psfParser's DFA does, from the first narrow and the token after it
+    types, i = self.types, self.i
+    t0 = types[i]
+    t1 = types[self.phrase_end(i) if t0 == LSB else i+1]
+    if t0 == TOKEN and t1 in (VOCTAG, INTTAG):  # tagexpr, which process_chain() has no case for
+      raise Unparsed()
+    elif t0 == DOLLARTOKEN and t1 == DCOLON:
+      self.conjexpr(key)
+    elif t0 in (LRB, LCB) or t1 in LINE_FOLLOW:
+      heads, typ = self.lc(key)
+      if typ in (DOLLARTOKEN, LCB):  # process_chain() is not called on these alone
+        raise Unparsed()
+    elif t1 == EQ:
+      self.corefexpr(key)
+    else:
+      raise Unparsed()
+
+  def phrase_end(self, i):
+    """Index after the [a b] phrase at i"""
+    types = self.types
+    j = i+1
+    while types[j] == TOKEN: j += 1
+    if types[j] != RSB or j-i < 3:
+      raise Unparsed()
+    return j+1
+
+  def corefexpr(self, key):
+    first = self.narrow(key+(0,))
+    self.expect(EQ)
+    second = self.narrow(key+(1,))
+    self.p.add_node_edge(first[0], second[0], 'Anaph')
+
+  def conjexpr(self, key):
+    p = self.p
+    nodename = self.leaf()
+    self.i += 1  # ::
+    head_nodes, _ = self.atom(key+(1,))
+    extra_nodes = []
+    if self.types[self.i] == DCOLON:
+      self.i += 1
+      extra_nodes, _ = self.atom(key+(2,))
+    for n in extra_nodes:
+      self.touch(key+(3,), n)
+    extra_words = flatten(p.node2words[n] for n in extra_nodes)
+    for n in head_nodes:
+      p.add_node_edge(nodename, n, 'Conj')
+    for w in extra_words:
+      p.add_nodeword_edge(nodename, w, 'Coord')
+
+  def lc(self, key):
+    # rc (< rc)*: each rc's heads head the next one's
+    heads, typ = self.rc(key+(0,))
+    last = heads
+    j = 1
+    while self.types[self.i] == LARROW:
+      self.i += 1
+      children, _ = self.rc(key+(j,))
+      for x in last:
+        for y in children:
+          self.p.add_node_edge(x, y)
+      last = children
+      typ = LARROW
+      j += 1
+    return heads, typ
+
+  def rc(self, key):
+    # atom (> atom)*: each atom's heads head the previous one's
+    heads, typ = self.atom(key+(0,))
+    j = 1
+    while self.types[self.i] == RARROW:
+      self.i += 1
+      parents, _ = self.atom(key+(-j,))
+      for x in parents:
+        for y in heads:
+          self.p.add_node_edge(x, y)
+      heads = parents
+      typ = RARROW
+      j += 1
+    return heads, typ
+
+  def atom(self, key):
+    typ = self.types[self.i]
+    if typ == LCB:
+      self.i += 1
+      nodes = []
+      j = 0
+      while self.types[self.i] in ATOM_START:
+        nodes += self.atom(key+(j,))[0]
+        j += 1
+      if j == 0:  # the { of an empty {} is a leaf
+        self.leaves.append((LCB, u'{'))
+      self.expect(RCB)
+      return nodes, LCB
+    elif typ == LRB:
+      return self.cbb(key), LRB
+    else:
+      return self.narrow(key), typ
+
+  def narrow(self, key):
+    p = self.p
+    typ = self.types[self.i]
+    if typ == TOKEN:
+      text = self.leaf()
+      nodename = u'W(' + text + u')'
+      self.touch(key, nodename)
+      p.add_nodeword_edge(nodename, text)
+      return [nodename]
+    elif typ == DOLLARTOKEN:
+      return [self.leaf()]
+    elif typ == LSB:
+      self.phrase_end(self.i)
+      self.i += 1
+      words = []
+      while self.types[self.i] == TOKEN:
+        words.append(self.texts[self.i])
+        self.narrow(key+(len(words),))
+      self.i += 1  # ]
+      mw_node = u'MW(' + u'_'.join(words) + u')'
+      if p.multiword_canonical_node(words) not in (None, mw_node):
+        raise Unparsed()
+      self.touch(key+(len(words)+1,), mw_node)
+      for w in words:
+        p.add_nodeword_edge(mw_node, w)
+      return [mw_node]
+    raise Unparsed()
+
+  def cbb(self, key):
+    # ( expr+ (* expr*)? ): with a star, the head is processed first
+    self.i += 1
+    exprs = []
+    head = None  # index of the starred expr
+    while True:
+      while self.types[self.i] in ATOM_START:
+        order = [1]
+        exprs.append(self.lc(key+(order, len(exprs))) + (order,))
+      if head is None and exprs and self.types[self.i] == HEAD:
+        head = len(exprs)-1
+        exprs[head][2][0] = 0
+        self.leaf()
+      else:
+        break
+    self.expect(RRB)
+    if not exprs:
+      raise Unparsed()
+    if len(exprs) == 1 and head is None:  # a singleton is promoted into this place
+      return exprs[0][0]
+
+    cbb_nodeid = u'CBB%s' % self.p.next_cbb_id()
+    self.cbbs.append((key, cbb_nodeid))
+    if head is not None:
+      headnodes, typ, _ = exprs[head]
+      if typ == LCB or len(headnodes) != 1:
+        raise Unparsed()
+      self.p.add_node_edge(cbb_nodeid, headnodes[0], 'cbbhead')
+    for j, (heads, _, _) in enumerate(exprs):
+      if j != head:
+        for c in heads:
+          self.p.add_node_edge(cbb_nodeid, c, 'unspec')
+    return [cbb_nodeid]
+
+  def reorder(self):
+    """
+    Number the CBBs in process_chain()'s order rather than in the order their
+    ) was reached, and refill node2words in that order.
+    """
+    p = self.p
+    names = {old: u'CBB%d' % (n+1) for n,(_,old) in enumerate(sorted(self.cbbs))}
+    renamed = any(names[old] != old for old in names)
+    rename = lambda n: names.get(n, n)
+    if renamed:
+      edges = set()
+      for h,c,l in p.node_edges:
+        h, c = rename(h), rename(c)
+        if l in UndirectedEdges:  # add_node_edge() stores these sorted
+          h, c = sorted((h, c))
+        edges.add((h,c,l))
+      p.node_edges = edges
+    order = sorted(self.added, key=self.first.get)
+    if renamed or order != self.added:
+      node2words = defaultdict(set)
+      for n in order:
+        node2words[rename(n)] = p.node2words[n]
+      p.node2words = node2words
+
+def parser_version():
+  """Hash of the parser's source files, so that cached parses go stale when it changes."""
+  h = hashlib.sha1()
+  here = os.path.dirname(os.path.abspath(__file__))
+  for name in ('gfl_parser.py', 'psfLexer.py', 'psfParser.py'):
+    with open(os.path.join(here, name), 'rb') as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+class ParseCache(object):
+  """
+  On-disk cache of parse() results, one pickled Parse per file, keyed by a
+  hash of the tokens, the cleaned code, check_semantics and the parser
+  version.  Annotations that fail to parse are not cached.  A cached Parse
+  is equal to a fresh one, though its sets and dicts may iterate in a
+  different order.
+
+    cache = ParseCache('.gflcache')
+    p = cache.parse(tokens, code, session=session)
+
+  Hits refresh the file's modification time; once the cache exceeds
+  max_bytes, the least recently used files are removed until it is back
+  under 90% of that.  Several processes may share a directory (files are
+  written atomically), each keeping its own estimate of the total size.
+  """
+  def __init__(self, directory, max_bytes=256*2**20):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.version = parser_version()
+    self.hits = self.misses = 0
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:  # created concurrently
+        if not os.path.isdir(directory): raise
+    self.size = sum(size for mtime,size,path in self.entries())
+
+  def entries(self):
+    """(mtime, size, path) of each cached parse"""
+    for name in os.listdir(self.directory):
+      if name.endswith('.pkl'):
+        path = os.path.join(self.directory, name)
+        try:
+          st = os.stat(path)
+        except OSError:  # removed concurrently
+          continue
+        yield st.st_mtime, st.st_size, path
+
+  def key(self, text_tokens, psf_code, check_semantics=False):
+    h = hashlib.sha1(self.version)
+    h.update(repr(bool(check_semantics)))
+    for w in text_tokens:
+      h.update(unicodify(w).encode('utf8') + '\0')
+    h.update('\0')
+    h.update(unicodify(clean_code(psf_code)).encode('utf8'))
+    return h.hexdigest()
+
+  def parse(self, text_tokens, psf_code, check_semantics=False, session=None):
+    """Like parse(), but reusing a cached result where there is one."""
+    path = os.path.join(self.directory, self.key(text_tokens, psf_code, check_semantics)+'.pkl')
+    try:
+      with open(path, 'rb') as f:
+        p = pickle.load(f)
+      os.utime(path, None)
+      self.hits += 1
+      return p
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+      pass
+    self.misses += 1
+    if session:
+      p = session.parse(text_tokens, psf_code, check_semantics=check_semantics)
+    else:
+      p = parse(text_tokens, psf_code, check_semantics=check_semantics)
+    data = pickle.dumps(p, pickle.HIGHEST_PROTOCOL)
+    fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.rename(tmppath, path)
+    self.size += len(data)
+    if self.size > self.max_bytes:
+      self.evict()
+    return p
+
+  def evict(self):
+    entries = sorted(self.entries())
+    self.size = sum(size for mtime,size,path in entries)
+    for mtime,size,path in entries:
+      if self.size <= 0.9*self.max_bytes: break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      self.size -= size
+
 def antlr_dump(node, indent=0):
   print "{indent} {typ} {info}".format(
       indent=' '*(indent*4), 
@@ -623,6 +1241,128 @@ def test_orphans():
   assert 'W(d)' not in p.node2words
 
 
+def test_session():
+  session = GFLParserSession()
+  codes = ["a < b < c", "[a b] > {c d}", "$x :: {b c} :: {p q}", "a > b > c \n a = c", "a < b < ({c d} > e)"]
+  for c in codes:
+    assert_same(goparse(string.letters, c), session.parse(string.letters, clean_code(c)))
+  # reuse after a failed parse
+  import pytest
+  with pytest.raises(ParseError):
+    session.parse("A B C A A".split(), "A > B")
+  assert_same(goparse(string.letters, "a < b"), session.parse(string.letters, "a < b"))
+
+def test_numberize():
+  go = lambda c: goparse(string.letters, c)
+  vocab = Vocab()
+  for c in ["a < b < c", "[a b] > {c d}", "$x :: {b c} :: {p q}", "a > b > c \n a = c"]:
+    p = go(c)
+    d = p.to_json(numberize=True)
+    assert d['nodes'] == sorted(p.nodes)
+    assert set((d['nodes'][h], d['nodes'][c], l) for h,c,l in d['node_edges']) == p.node_edges
+    assert {d['nodes'][n]: {d['tokens'][w] for w in ws} for n,ws in d['node2words'].items()} == p.node2words
+    # lossless, including through JSON (which turns node ids into string keys)
+    assert_same(p, Parse.from_json(json.loads(json.dumps(d))))
+    assert_same(p, Parse.from_json(p.numberize(vocab).to_json()))
+  assert vocab.strings.count('W(a)') == 1
+  # without edges, only the words tell (and a node may have none)
+  assert is_numberized_json(go("a").to_json(numberize=True))
+  assert not is_numberized_json({'node_edges': [], 'node2words': {'W(a)': []}})
+  assert not is_numberized_json({'node_edges': [], 'node2words': {}})
+
+
+def test_cache(tmpdir):
+  cache = ParseCache(str(tmpdir), max_bytes=10**9)
+  codes = ["a < b < c", "[a b] > {c d}", "$x :: {b c} :: {p q}"]
+  for c in codes:
+    assert_same(goparse(string.letters, c), cache.parse(string.letters, c))
+  assert (cache.hits, cache.misses) == (0, 3)
+  # keyed by the cleaned code
+  p = cache.parse(string.letters, "\n  " + codes[0] + "\n")
+  assert (cache.hits, cache.misses) == (1, 3)
+  assert_same(goparse(string.letters, codes[0]), p)
+  assert p.node2words == goparse(string.letters, codes[0]).node2words
+  assert cache.parse(string.letters, codes[0], check_semantics=True) and cache.misses == 4
+  # failures are not cached
+  import pytest
+  with pytest.raises(ParseError):
+    cache.parse("A B C A A".split(), "A > B")
+  assert len(list(cache.entries())) == 4
+  # the least recently used entries are evicted first
+  for i,(mtime,size,path) in enumerate(sorted(cache.entries())):
+    os.utime(path, (i, i))
+  cache.parse(string.letters, codes[0])
+  cache.max_bytes = cache.size
+  cache.parse(string.letters, "d < e")
+  names = os.listdir(str(tmpdir))
+  assert len(names) < 5
+  assert cache.key(string.letters, codes[0]) + '.pkl' in names
+  assert cache.key(string.letters, "d < e") + '.pkl' in names
+
+def psflexer_tokens(code):
+  """(type, text, start, line, column) for psfLexer's on-channel tokens, and its error messages"""
+  lexer = psfLexer(antlr3.ANTLRStringStream(code))
+  errors = []
+  lexer.emitErrorMessage = errors.append
+  tokens = []
+  while True:
+    t = lexer.nextToken()
+    if t.type == EOF: return tokens, errors
+    if t.channel == antlr3.DEFAULT_CHANNEL:
+      tokens.append((t.type, t.text, t.start, t.line, t.charPositionInLine))
+
+def test_regex_lexer():
+  import glob
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../scripts'))
+  import view
+  here = os.path.dirname(os.path.abspath(__file__))
+  codes = [u"::", u"::x", u"a :: b", u"-->", u"x-->y", u"<-->", u"=", u"==", u"a = b", u"//c\na", u"a//b",
+           u"$x", u"$x-y", u"$1", u"\\v", u"\\ voc x", u"\\vo", u"\\vocative", u"\\ I", u"\\interjection",
+           u"a\u3000b\r\nc\u2028d", u"(a b* c)", u"[a b] > {c d}"]
+  for filename in glob.glob(os.path.join(here, '../anno/*.anno')) + glob.glob(os.path.join(here, '../anno/*/*.anno')):
+    codes.extend(code for tokens,code,text,lines in view.iter_containers(filename) if code)
+  assert len(codes) > 80
+  for code in codes:
+    tokens, errors = psflexer_tokens(code)
+    assert not errors
+    assert list(lex(code)) == tokens, code
+  import pytest
+  for code in [u"a \\ x", u"\\ vo", u"\\ "]:
+    assert psflexer_tokens(code)[1]
+    with pytest.raises(ParseError):
+      list(lex(code))
+  for c in ["a < b < c", "[a b] > {c d}", "$x :: {b c} :: {p q}", "a > b > c \n a = c"]:
+    assert_same(goparse(string.letters, c), parse(string.letters, clean_code(c), regex_lexer=True))
+    assert_same(goparse(string.letters, c), GFLParserSession(regex_lexer=True).parse(string.letters, clean_code(c)))
+
+def test_direct_parser():
+  import glob, pytest
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../scripts'))
+  import view
+  here = os.path.dirname(os.path.abspath(__file__))
+  def to_json(tokens, code, **kwargs):
+    try:
+      return json.dumps(parse(tokens, code, **kwargs).to_json())  # (down to the order of dict keys)
+    except Exception as e:
+      return type(e), str(e).split('\n')[0]  # (pytest adds to assertion messages)
+  items = [(string.letters, c) for c in
+           ["a < b < c", "[a b] > {c d}", "$x :: {b c} :: {p q}", "a > b > c \n a = c", "a < b > c",
+            "(a b) > (c d)", "(a (b c)) < (d* e)", "((a b) c*) = (d e)", "[a b] = [b a]", "(a)", "(a *)",
+            "{}", "{a b} < ({} c)", "a \\v", "$x", "{a b}", "({a b}* c)", "a ) b", "a < b ) c", "", "A > a"]]
+  for filename in glob.glob(os.path.join(here, '../anno/*.anno')) + glob.glob(os.path.join(here, '../anno/*/*.anno')):
+    items.extend((tokens, code) for tokens,code,text,lines in view.iter_containers(filename) if code)
+  assert len(items) > 80
+  session = GFLParserSession(backend='direct')
+  for tokens, code in items:
+    expected = to_json(tokens, code)
+    assert to_json(tokens, code, backend='direct') == expected, code
+    assert to_json(tokens, code, session=session) == expected, code
+  # CBBs are numbered in process_chain()'s order, heads first
+  assert ('CBB1', 'CBB2', None) in parse(string.letters, "(a b) > (c d)", backend='direct').node_edges
+  # psfParser's error recovery is left to psfParser
+  for code in ["a ) b", "a \\v", "[a b] = [b a]"]:
+    with pytest.raises(Unparsed):
+      DirectParser(code).parse(list(string.letters))
 
 def assert_same(p1, p2):
   # Note this is a pretty lame test, it assumes nodes have common names between parses.
@@ -0,0 +1,225 @@
+#!/usr/bin/env python2.7
+#coding=UTF-8
+'''
+Compact binary form of FUDG JSON files (see FUDG_JSON.md), converting
+losslessly to and from the JSON form.
+
+A file starts with MAGIC, followed by one length-prefixed item per annotation
+(an empty item stands for a blank line, as written by merge_annotations.py).
+Strings (tokens, node names, words, labels) are interned in a table that grows
+as the file is written: each item first lists the strings it introduces,
+then its locator and raw sentence, then its graph as columns of string ids
+(numbered from 1, with 0 for a null label):
+
+  tokens; nodes;
+  node2words keys, their word counts, and the words;
+  extra_node2words keys, their pair counts, and the (word, label) pairs;
+  node_edges heads, children, and labels
+
+stored as the 12 column lengths followed by the concatenated columns,
+and then any other keys of the graph as JSON.
+A graph that does not fit this layout is stored as JSON instead.
+All integers are little-endian 32-bit.
+
+Reading yields fudg_json Records, whose graphs are decoded on first access;
+fudg_json.records() recognizes binary input by its first line.
+
+  fudg_binary.py [-j] [file...]
+
+converts FUDG JSON to binary (or with -j, binary to FUDG JSON) on stdout.
+'''
+from __future__ import print_function, division
+import sys, json, struct
+from array import array
+
+from fudg_json import Record
+
+MAGIC = 'FUDGB1\n'
+
+COLUMNAR, JSON = 0, 1
+
+GRAPH_KEYS = ('tokens', 'nodes', 'node2words', 'extra_node2words', 'node_edges')
+
+def int32s(columns):
+	a = array('i', (x for column in columns for x in column))
+	if sys.byteorder!='little': a.byteswap()
+	return struct.pack('<{}I'.format(len(columns)), *map(len, columns)) + a.tostring()
+
+def bytestring(s):
+	return struct.pack('<I', len(s)) + s
+
+class Writer(object):
+	'''Writes items to a binary FUDG file.'''
+	def __init__(self, outF):
+		self.outF = outF
+		self.ids = {None: 0}
+		outF.write(MAGIC)
+
+	def intern(self, s, new):
+		if s not in self.ids:
+			self.ids[s] = len(self.ids)
+			new.append(s)
+		return self.ids[s]
+
+	def columns(self, graph, new):
+		'''The graph's columns of string ids, or None if it has a different layout.'''
+		strs = lambda xs: all(isinstance(x, basestring) for x in xs)
+		n2w, xn2w = graph['node2words'], graph.get('extra_node2words', {})
+		edges = graph['node_edges']
+		if not (strs(graph['tokens']) and strs(graph['nodes']) and strs(n2w) and strs(xn2w)
+				and all(strs(ws) for ws in n2w.values())
+				and all(len(x)==2 and isinstance(x[0], basestring) and (x[1] is None or isinstance(x[1], basestring))
+						for pairs in xn2w.values() for x in pairs)
+				and all(len(e)==3 and strs(e[:2]) and (e[2] is None or isinstance(e[2], basestring)) for e in edges)):
+			return None
+		ids = lambda xs: [self.intern(x, new) for x in xs]
+		return [ids(graph['tokens']), ids(graph['nodes']),
+				ids(n2w.keys()), [len(ws) for ws in n2w.values()], ids(w for ws in n2w.values() for w in ws),
+				ids(xn2w.keys()), [len(pairs) for pairs in xn2w.values()],
+				ids(w for pairs in xn2w.values() for w,l in pairs), ids(l for pairs in xn2w.values() for w,l in pairs),
+				ids(h for h,c,l in edges), ids(c for h,c,l in edges), ids(l for h,c,l in edges)]
+
+	def write_blank(self):
+		self.outF.write(struct.pack('<I', 0))
+
+	def write(self, locator, sentence, graph):
+		new = []
+		columns = self.columns(graph, new) if all(k in graph for k in GRAPH_KEYS if k!='extra_node2words') else None
+		if columns is None:
+			body = struct.pack('<B', JSON) + bytestring(json.dumps(graph))
+		else:
+			rest = {k: v for k,v in graph.items() if k not in GRAPH_KEYS}
+			# remember whether extra_node2words was present, since it is optional
+			body = struct.pack('<BB', COLUMNAR, 'extra_node2words' in graph) + int32s(columns) \
+				+ bytestring(json.dumps(rest) if rest else '')
+		head = struct.pack('<I', len(new)) + ''.join(bytestring(s.encode('utf-8')) for s in new) \
+			+ bytestring(locator) + bytestring(sentence)
+		self.outF.write(struct.pack('<I', len(head)+len(body)) + head + body)
+
+class Reader(object):
+	'''
+	Iterates over the items of a binary FUDG file (after MAGIC) as Records,
+	given its remaining contents as a file-like object.
+	'''
+	def __init__(self, inF, offset=len(MAGIC)):
+		self.inF = inF
+		self.offset = offset
+		self.strings = [None]
+
+	def __iter__(self):
+		while True:
+			size = self.inF.read(4)
+			if not size: return
+			(size,) = struct.unpack('<I', size)
+			if size==0:
+				yield None
+				self.offset += 4
+				continue
+			item = self.inF.read(size)
+			pos = 0
+			(nnew,) = struct.unpack_from('<I', item, pos)
+			pos += 4
+			for _ in xrange(nnew):
+				s, pos = unpack_bytestring(item, pos)
+				self.strings.append(s.decode('utf-8'))
+			locator, pos = unpack_bytestring(item, pos)
+			sentence, pos = unpack_bytestring(item, pos)
+			yield Record.from_encoded(locator, sentence, item[pos:], self.decode, self.offset)
+			self.offset += 4+size
+
+	def decode(self, body):
+		'''The JSON object for an item's graph section.'''
+		kind, = struct.unpack_from('<B', body, 0)
+		if kind==JSON:
+			return json.loads(unpack_bytestring(body, 1)[0])
+		has_extra, = struct.unpack_from('<B', body, 1)
+		lengths = struct.unpack_from('<12I', body, 2)
+		pos = 2+4*12
+		ints = array('i', body[pos:pos+4*sum(lengths)])
+		if sys.byteorder!='little': ints.byteswap()
+		pos += 4*sum(lengths)
+		ints = ints.tolist()
+		strs = map(self.strings.__getitem__, ints)	# (meaningless for the count columns)
+		bounds = [0]
+		for n in lengths:
+			bounds.append(bounds[-1]+n)
+		column = lambda i, values=strs: values[bounds[i]:bounds[i+1]]
+		rest = unpack_bytestring(body, pos)[0]
+		graph = json.loads(rest) if rest else {}
+		graph['tokens'] = column(0)
+		graph['nodes'] = column(1)
+		graph['node2words'] = grouped(column(2), column(3, ints), column(4))
+		if has_extra:
+			graph['extra_node2words'] = grouped(column(5), column(6, ints), map(list, zip(column(7), column(8))))
+		graph['node_edges'] = map(list, zip(column(9), column(10), column(11)))
+		return graph
+
+def unpack_bytestring(buf, pos):
+	(n,) = struct.unpack_from('<I', buf, pos)
+	return buf[pos+4:pos+4+n], pos+4+n
+
+def grouped(keys, counts, values):
+	d = {}
+	i = 0
+	for k,n in zip(keys, counts):
+		d[k] = values[i:i+n]
+		i += n
+	return d
+
+class LineStream(object):
+	'''File-like read() over an iterable of lines (e.g. fileinput), for binary input read by line.'''
+	def __init__(self, lines):
+		self.lines = iter(lines)
+		self.buf = ''
+
+	def read(self, n):
+		while len(self.buf)<n:
+			ln = next(self.lines, None)
+			if ln is None: break
+			self.buf += ln
+		s, self.buf = self.buf[:n], self.buf[n:]
+		return s
+
+def test():
+	from StringIO import StringIO
+	from fudg_json import records
+	graphs = [{"tokens": ["Friendly", ",", "and", "fair", "é"], "nodes": ["$a", "W(Friendly)", "W(fair)", "W(é)"],
+			   "node_edges": [["$a", "W(Friendly)", "Conj"], ["$a", "W(fair)", "Conj"], ["W(fair)", "W(é)", None]],
+			   "extra_node2words": {"$a": [["and", "Coord"]]},
+			   "node2words": {"W(fair)": ["fair"], "W(Friendly)": ["Friendly"], "W(é)": ["é"]}},
+			  {"tokens": ["x"], "nodes": ["W(x)"], "node_edges": [], "node2words": {"W(x)": ["x"]}, "comment": "other keys"},
+			  {"tokens": ["x"], "node_edges": [["W(x)", "W(x)", 3]], "node2words": {}, "nodes": []}]	# not columnar
+	graphs = json.loads(json.dumps(graphs))
+	outF = StringIO()
+	writer = Writer(outF)
+	for i,g in enumerate(graphs):
+		writer.write('item:{}'.format(i), ' '.join(g['tokens']).encode('utf-8'), g)
+	writer.write_blank()
+	data = outF.getvalue()
+	assert data.startswith(MAGIC)
+	for recs in (records(StringIO(data)), records(data.splitlines(True))):
+		recs = list(recs)
+		assert recs.pop() is None
+		assert [r.locator for r in recs] == ['item:0', 'item:1', 'item:2']
+		assert [r.graph for r in recs] == graphs
+		assert json.loads(recs[0].rawjson) == graphs[0]
+
+if __name__=='__main__':
+	from optparse import OptionParser
+	from fudg_json import records
+	p = OptionParser(usage="%prog [-j] [file...]")
+	p.add_option('-j', dest='tojson', action='store_true', help="convert binary to FUDG JSON (default: FUDG JSON to binary)")
+	opts,args = p.parse_args()
+
+	if opts.tojson:
+		for filename in args or ['/dev/stdin']:
+			for rec in records(filename):
+				print(rec if rec is not None else '')
+	else:
+		writer = Writer(sys.stdout)
+		for filename in args or ['/dev/stdin']:
+			for rec in records(filename):
+				if rec is None:
+					writer.write_blank()
+				else:
+					writer.write(rec.locator, rec.sentence, rec.graph)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python2.7
+#coding=UTF-8
+'''
+Streaming reader for FUDG JSON files (see FUDG_JSON.md): one item per line,
+with tab-separated locator, raw sentence, and JSON graph columns.
+
+Records are lightweight: the locator and sentence are split off the line,
+but the JSON column is only decoded when a consumer accesses the graph,
+so filtering a large file by locator or length does not decode every graph.
+Input can be read from any iterable of lines (a file, fileinput, stdin) or
+from a memory-mapped file; each record knows the byte offset of its line,
+so it can be read again directly with record_at().
+
+An Index is a sidecar file (FILE.idx) mapping each locator to the offset of
+its line, along with its token and node counts, for random access by locator.
+
+When called directly, filters FUDG JSON lines without decoding them,
+or looks up items by locator (building the index if necessary):
+
+  fudg_json.py [-l LOCATOR_REGEX] [--min-tokens N] [--max-tokens N] file...
+  fudg_json.py -g LOCATOR [-g LOCATOR ...] file
+'''
+from __future__ import print_function, division
+import os, re, sys, json, mmap, itertools
+from array import array
+
+class Record(object):
+	'''One item of a FUDG JSON file.'''
+	__slots__ = ('locator', 'sentence', 'offset', '_line', '_start', '_end', '_graph', '_decode')
+
+	def __init__(self, line, offset=None, start=0, end=None):
+		'''
+		line is the text containing the item (a str or mmap), with the item
+		spanning [start, end) (excluding the newline)
+		'''
+		if end is None: end = len(line)
+		tab1 = line.find('\t', start, end)
+		tab2 = line.find('\t', tab1+1, end)
+		if tab1<0 or tab2<0:
+			raise ValueError('Expected 3 tab-separated columns in FUDG JSON line at offset {}'.format(offset))
+		self.locator = line[start:tab1]
+		self.sentence = line[tab1+1:tab2]
+		self.offset = offset
+		self._line, self._start, self._end = line, tab2+1, end
+		self._graph = self._decode = None
+
+	@staticmethod
+	def from_encoded(locator, sentence, encoded, decode, offset=None):
+		'''A Record whose graph is decode(encoded), e.g. from fudg_binary.'''
+		rec = Record.__new__(Record)
+		rec.locator, rec.sentence, rec.offset = locator, sentence, offset
+		rec._line, rec._start, rec._end = encoded, 0, len(encoded)
+		rec._graph, rec._decode = None, decode
+		return rec
+
+	@property
+	def rawjson(self):
+		'''The undecoded JSON column.'''
+		if self._decode is not None:
+			return json.dumps(self.graph)
+		return self._line[self._start:self._end]
+
+	@property
+	def graph(self):
+		'''The decoded JSON object (decoded on first access).'''
+		if self._graph is None:
+			if self._decode is not None:
+				self._graph = self._decode(self._line[self._start:self._end])
+			else:
+				self._graph = json.loads(self.rawjson)
+		return self._graph
+
+	@property
+	def ntokens(self):
+		'''Number of tokens, counted in the raw sentence (without decoding the graph).'''
+		return len(self.sentence.split())
+
+	def __str__(self):
+		return '\t'.join((self.locator, self.sentence, self.rawjson))
+
+def records(source, use_mmap=False):
+	'''
+	Yield a Record for each line of the FUDG JSON input (a filename or
+	an iterable of lines), or None for a blank line. With use_mmap,
+	the file (source must be a filename) is memory-mapped rather than read.
+	Binary input (see fudg_binary.py) is recognized and read likewise.
+	'''
+	if use_mmap:
+		for rec in mmap_records(source):
+			yield rec
+		return
+	if isinstance(source, basestring):
+		with open(source) as inF:
+			for rec in records(inF):
+				yield rec
+		return
+	import fudg_binary
+	lines = iter(source)
+	first = next(lines, None)
+	if first==fudg_binary.MAGIC:
+		for rec in fudg_binary.Reader(fudg_binary.LineStream(lines)):
+			yield rec
+		return
+	offset = 0
+	for ln in itertools.chain([first] if first is not None else [], lines):
+		end = len(ln)-1 if ln.endswith('\n') else len(ln)
+		yield None if is_blank(ln, 0, end) else Record(ln, offset, 0, end)
+		offset += len(ln)
+
+def is_blank(line, start, end):
+	# only lines without a column separator are copied to check for whitespace
+	return line.find('\t', start, end)<0 and not line[start:end].strip()
+
+def mmap_records(filename):
+	with open(filename) as inF:
+		if os.fstat(inF.fileno()).st_size==0:	# empty files cannot be mapped
+			return
+		buf = mmap.mmap(inF.fileno(), 0, access=mmap.ACCESS_READ)
+	import fudg_binary
+	if buf[:len(fudg_binary.MAGIC)]==fudg_binary.MAGIC:
+		buf.seek(len(fudg_binary.MAGIC))
+		for rec in fudg_binary.Reader(buf):
+			yield rec
+		return
+	offset = 0
+	while offset<len(buf):
+		end = buf.find('\n', offset)
+		if end<0: end = len(buf)
+		yield None if is_blank(buf, offset, end) else Record(buf, offset, offset, end)
+		offset = end+1
+
+def record_at(f, offset):
+	'''The Record for the line starting at byte offset in f (a filename or seekable file).'''
+	if isinstance(f, basestring):
+		with open(f) as inF:
+			return record_at(inF, offset)
+	f.seek(offset)
+	return Record(f.readline().rstrip('\n'), offset)
+
+class Index(object):
+	'''
+	Sidecar index of a FUDG JSON file: for each locator, the byte offset of its
+	line and its numbers of tokens and nodes. The index file is tab-separated,
+	one item per line in file order, after a header recording the size and
+	modification time of the indexed file; a stale or missing index is rebuilt.
+	Where a locator occurs more than once, the first occurrence is indexed.
+	Binary files (see fudg_binary.py) cannot be indexed, since their items
+	can only be decoded in order.
+	'''
+	HEADER = '#FUDG JSON index'
+
+	def __init__(self, filename, indexfilename=None, rebuild=False):
+		self.filename = filename
+		self.indexfilename = indexfilename or filename+'.idx'
+		self.locators = []
+		self.rows = {}
+		self.offsets = array('l')
+		self.ntokens = array('i')
+		self.nnodes = array('i')
+		self._f = None
+		import fudg_binary
+		with open(filename) as inF:
+			if inF.read(len(fudg_binary.MAGIC))==fudg_binary.MAGIC:
+				raise ValueError('Cannot index binary FUDG file {} (convert it with fudg_binary.py -j first)'.format(filename))
+		if rebuild or not self.load():
+			self.build()
+
+	def stamp(self):
+		st = os.stat(self.filename)
+		return '{}\t{}\t{}'.format(self.HEADER, st.st_size, int(st.st_mtime))
+
+	def add(self, locator, offset, ntokens, nnodes):
+		if locator in self.rows: return
+		self.rows[locator] = len(self.locators)
+		self.locators.append(locator)
+		self.offsets.append(offset)
+		self.ntokens.append(ntokens)
+		self.nnodes.append(nnodes)
+
+	def load(self):
+		'''Read the index file, returning False if it is missing or stale.'''
+		if not os.path.exists(self.indexfilename):
+			return False
+		with open(self.indexfilename) as idxF:
+			if idxF.readline().rstrip('\n')!=self.stamp():
+				return False
+			for ln in idxF:
+				locator, offset, ntokens, nnodes = ln.rstrip('\n').split('\t')
+				self.add(locator, int(offset), int(ntokens), int(nnodes))
+		return True
+
+	def build(self):
+		'''Index the file (decoding each graph once to count its nodes) and write the index file.'''
+		stamp = self.stamp()
+		for rec in records(self.filename, use_mmap=True):
+			if rec is not None:
+				self.add(rec.locator, rec.offset, rec.ntokens, len(rec.graph['nodes']))
+		# write to a temporary file first so that an interrupted build leaves no index behind
+		with open(self.indexfilename+'.tmp', 'w') as idxF:
+			idxF.write(stamp+'\n')
+			for row in itertools.izip(self.locators, self.offsets, self.ntokens, self.nnodes):
+				idxF.write('{}\t{}\t{}\t{}\n'.format(*row))
+		os.rename(self.indexfilename+'.tmp', self.indexfilename)
+
+	def __len__(self):
+		return len(self.locators)
+
+	def __iter__(self):
+		return iter(self.locators)
+
+	def __contains__(self, locator):
+		return locator in self.rows
+
+	def seek(self, locator):
+		'''The Record for locator, read directly from its offset (KeyError if not indexed).'''
+		if self._f is None:
+			self._f = open(self.filename)
+		return record_at(self._f, self.offsets[self.rows[locator]])
+
+	def close(self):
+		if self._f is not None:
+			self._f.close()
+			self._f = None
+
+def test():
+	import tempfile
+	lines = ['a.anno:0\tx y\t{"tokens": ["x", "y"], "nodes": [], "node_edges": [], "node2words": {}, "extra_node2words": {}}\n',
+			 '\n',
+			 'b.anno:0\tz\tNOT JSON\n',
+			 'c.anno:0\tw\t{"tokens": ["w"]}']
+	with tempfile.NamedTemporaryFile(suffix='.json') as tmpF:
+		tmpF.write(''.join(lines))
+		tmpF.flush()
+		for use_mmap in (False, True):
+			recs = list(records(tmpF.name, use_mmap=use_mmap))
+			assert recs[1] is None
+			a, b, c = recs[0], recs[2], recs[3]
+			assert (a.locator, a.sentence, a.ntokens, a.offset) == ('a.anno:0', 'x y', 2, 0)
+			assert a.graph['tokens'] == ['x', 'y']
+			assert b.ntokens == 1	# the bad JSON is never decoded
+			assert str(b)+'\n' == lines[2]
+			assert c.graph == {'tokens': ['w']}
+			assert record_at(tmpF.name, c.offset).graph == c.graph
+		assert [str(r) for r in records(lines) if r] == [str(r) for r in records(tmpF.name) if r]
+
+	with tempfile.NamedTemporaryFile(suffix='.json') as tmpF:
+		tmpF.write(lines[0]+lines[1]+lines[0].replace('a.anno:0\tx y', 'a.anno:1\tx y z'))
+		tmpF.flush()
+		index = Index(tmpF.name)
+		try:
+			assert list(index) == ['a.anno:0', 'a.anno:1']
+			assert (index.ntokens[1], index.nnodes[1]) == (3, 0)
+			assert index.seek('a.anno:1').sentence == 'x y z'
+			assert list(Index(tmpF.name)) == list(index)	# loaded from the index file
+		finally:
+			index.close()
+			os.remove(index.indexfilename)
+
+	import fudg_binary
+	with tempfile.NamedTemporaryFile(suffix='.bin') as tmpF:
+		fudg_binary.Writer(tmpF).write('a.anno:0', 'x y', json.loads(lines[0].split('\t')[2]))
+		tmpF.flush()
+		try:
+			Index(tmpF.name)
+			assert False
+		except ValueError as ex:
+			assert 'binary' in str(ex)
+		assert not os.path.exists(tmpF.name+'.idx')
+
+if __name__=='__main__':
+	from optparse import OptionParser
+	p = OptionParser(usage="%prog [-l LOCATOR_REGEX] [--min-tokens N] [--max-tokens N] file...\n       %prog -g LOCATOR [-g LOCATOR ...] file")
+	p.add_option('-l', dest='locator', help="keep items whose locator matches this regex")
+	p.add_option('--min-tokens', dest='mintokens', type='int')
+	p.add_option('--max-tokens', dest='maxtokens', type='int')
+	p.add_option('-g', dest='get', action='append', help="print the item with this locator, using the index")
+	opts,args = p.parse_args()
+
+	if opts.get:
+		assert len(args)==1,'Looking up locators requires a single file'
+		index = Index(args[0])
+		for locator in opts.get:
+			print(index.seek(locator))
+		sys.exit(0)
+
+	for filename in args or ['/dev/stdin']:
+		for rec in records(filename, use_mmap=(filename!='/dev/stdin')):
+			if rec is None: continue
+			if opts.locator and not re.search(opts.locator, rec.locator): continue
+			if opts.mintokens is not None and rec.ntokens<opts.mintokens: continue
+			if opts.maxtokens is not None and rec.ntokens>opts.maxtokens: continue
+			print(rec)
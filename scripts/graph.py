@@ -55,10 +55,56 @@ class TreeNode(object):
                         [child.deepcopy() for child in self.children])
                         
 
-def reachable(n1,n2):
-	if n1 is n2: return True
-	for c in n1.children:
-		if reachable(c,n2): return True
+_nodeorder = itertools.count()
+
+def _canonical(n):
+	'''A CBB that has been merged into another CBB stands for that CBB.'''
+	return n._pointerto if n.isCBB and n._pointerto is not None else n
+
+def _add_order_edge(parent, child):
+	'''
+	Maintain .order, a topological order over all nodes (parents before children), 
+	for a new edge parent->child, using the dynamic topological sort of 
+	Pearce & Kelly (2006). Raises an exception if the edge would create a cycle.
+	Only nodes whose position lies between that of the child and that of the parent 
+	are visited, so most insertions cost O(1).
+	'''
+	parent, child = _canonical(parent), _canonical(child)
+	lb, ub = child.order, parent.order
+	if lb>ub: return	# already consistent
+	
+	# descendants of the child that precede the parent (the parent among them means a cycle)
+	fwd = [child]
+	seen = {child}
+	i = 0
+	while i<len(fwd):
+		for c in fwd[i].children:
+			c = _canonical(c)
+			if c is parent:
+				raise Exception('Adding {0} as a child of {1} would create a cycle!'.format(child,parent))
+			if c not in seen and c.order<ub:
+				seen.add(c)
+				fwd.append(c)
+		i += 1
+	
+	# ancestors of the parent that follow the child
+	bwd = [parent]
+	seen = {parent}
+	i = 0
+	while i<len(bwd):
+		for p in bwd[i]._preds:
+			p = _canonical(p)
+			if p not in seen and p.order>lb:
+				seen.add(p)
+				bwd.append(p)
+		i += 1
+	
+	# reassign the positions held by the affected nodes so that all ancestors come first
+	fwd.sort(key=lambda n: n.order)
+	bwd.sort(key=lambda n: n.order)
+	affected = bwd+fwd
+	for n,o in zip(affected, sorted(n.order for n in affected)):
+		n.order = o
 
 class FUDGNode(TreeNode):
 	def __init__(self, *args, **kwargs):
@@ -68,35 +114,44 @@ class FUDGNode(TreeNode):
 		self.parents = set()
 		self.height = 0	# length of longest path from this node to a leaf
 		self.depth = -1	# length of longest path from a parentless node to this one
+		self.order = next(_nodeorder)	# position in a topological order of all nodes
+		self._preds = set()	# nodes having this one as a child (for maintaining .order)
 		self.frag = Fragment({self}, {self})
 	
 	def add_child(self, node, label=None):
 		assert self.name!=node.name
 		assert not node.isRoot or (self.isCBB and label is not None)
+		# check for cycles
+		_add_order_edge(self, node)
 		TreeNode.add_child(self, node)
 		self.childedges.add((node, label))
-		# check for cycles
-		if reachable(node, self):
-			raise Exception('Adding {0} as a child of {1} would create a cycle!'.format(node,self))
+		_canonical(node)._preds.add(self)
 		
 		node.parentedges.add((self, label))
 		node.parents.add(self)
 		self._setMinHeight(node.height+1)
 		
 		#print(self,'.add_child',node)
-		self.frag |= node.frag	# unify the fragments, updating all references from member nodes
-		#self.frag.roots.remove(node)	# no longer a root because it has a parent
-		self.frag.roots -= {node}	# TODO
-
-		# recompute depths in the entire fragment
-		for n in self.frag.nodes:
-			n.depth = -1
-		for n in self.frag.roots:
-			n._setMinDepth(0)
+		self.frag |= node.frag	# unify the fragments
+		self.frag.discard_root(node)	# no longer a root because it has a parent
+
+		# depths only grow when an edge is added: update those below the new edge
+		if self.depth<0:	# first edge for a singleton fragment
+			self._setMinDepth(0)
+		node._setMinDepth(self.depth+1)
 	
 	def remove_child(self, child):
 		raise Exception('Not supported')
 	
+	@property
+	def frag(self):
+		'''The fragment (connected component) containing this node.'''
+		self._frag = self._frag.find()
+		return self._frag
+	@frag.setter
+	def frag(self, fragment):
+		self._frag = fragment
+	
 	def _setMinHeight(self, h):
 		if self.height<h:
 			self.height = h
@@ -197,7 +252,10 @@ class CBBNode(FUDGNode):
 		if node.top is None: node.top = self.top
 		else: self.top = node.top
 		node.height = max(self.height,node.height)
-		node.depth = max(self.depth,node.depth)
+		node._setMinDepth(self.depth)
+		for p in self._preds:	# edges into this CBB now lead into the other one
+			_add_order_edge(p, node)
+			node._preds.add(p)
 		for c in self.externalchildren:
 			node.add_child(c)
 		self.externalchildren = node.externalchildren
@@ -213,14 +271,14 @@ class CBBNode(FUDGNode):
 	def json_name(self): return self.name if self._pointerto is None else self._pointerto.name
 	
 	def __getattr__(self, name):
-		if name not in ('parentcandidates', 'topcandidates', 'height', 'depth'):
+		if name not in ('parentcandidates', 'topcandidates', 'height', 'depth', 'order'):
 			raise AttributeError(name)
 		if self._pointerto is not None:
 			#assert getattr(self._pointerto, '_'+name) is not None,self.__dict__
 			return getattr(self._pointerto, '_'+name)
 		return self.__dict__['_'+name]
 	def __setattr__(self, name, val):
-		if name in ('parentcandidates', 'topcandidates', 'height', 'depth'):
+		if name in ('parentcandidates', 'topcandidates', 'height', 'depth', 'order'):
 			if self._pointerto is not None:
 				self._pointerto.__setattr__(name, val)
 			else:
@@ -229,23 +287,77 @@ class CBBNode(FUDGNode):
 			FUDGNode.__setattr__(self, name, val)
 	
 class Fragment(object):
+	'''
+	A set of connected nodes and the ones among them that have no parents (roots).
+	
+	Fragments form a disjoint-set forest (union by rank with path compression): 
+	merging two fragments makes one the parent of the other, and the representative 
+	at the top of the tree stands for the whole fragment. The nodes and roots 
+	of absorbed fragments are only folded into the representative when they are 
+	next accessed, so merges take near-constant time.
+	'''
 	def __init__(self, roots, nodes):
-		self.roots = roots
 		for root in roots:
 			assert root in nodes
-		self.nodes = nodes
-		
+		self._roots = roots
+		self._nodes = nodes
+		self._nonroots = set()	# nodes to be removed from _roots
+		self._absorbed = []	# fragments merged into this one but not yet collected
+		self._parent = None
+		self._rank = 0
+	
+	def find(self):
+		'''The representative of this fragment.'''
+		root = self
+		while root._parent is not None:
+			root = root._parent
+		f = self
+		while f._parent is not None:	# path compression
+			f._parent, f = root, f._parent
+		return root
+	
+	def _collect(self):
+		'''Fold the contents of absorbed fragments into this one.'''
+		stack = self._absorbed
+		self._absorbed = []
+		while stack:
+			f = stack.pop()
+			self._nodes |= f._nodes
+			self._roots |= f._roots
+			self._nonroots |= f._nonroots
+			stack.extend(f._absorbed)
+			f._nodes = f._roots = f._nonroots = None
+			f._absorbed = []
+		if self._nonroots:
+			self._roots -= self._nonroots
+			self._nonroots = set()
+	
+	@property
+	def nodes(self):
+		f = self.find()
+		f._collect()
+		return f._nodes
+	
+	@property
+	def roots(self):
+		f = self.find()
+		f._collect()
+		return f._roots
+	
+	def discard_root(self, node):
+		self.find()._nonroots.add(node)
+	
 	def __or__(self, that):
-		if self is not that:
-			# merge 'that' contents in with 'self'
-			self.roots |= that.roots
-			self.nodes |= that.nodes
-			
-			# update node references from 'that' to point to 'self'
-			for n in that.nodes:
-				n.frag = self
-			
-		return self
+		'''Merge the two fragments, returning the representative of the result.'''
+		a, b = self.find(), that.find()
+		if a is not b:
+			if a._rank<b._rank:
+				a, b = b, a
+			elif a._rank==b._rank:
+				a._rank += 1
+			b._parent = a
+			a._absorbed.append(b)
+		return a
 
 	def __repr__(self):
 		return '<Fragment@'+str(id(self))+'> '+str(self.roots)+' '+str(self.nodes)
@@ -357,17 +469,16 @@ class FUDGGraph(Graph):
 		
 
 		
-		# merge CBBs with identical member sets
-		cbbs = list(sorted(self.cbbnodes, key=lambda n: n.name))
-		assert None not in cbbs
-		for i in range(len(cbbs)):
-			for h in range(i):
-				if cbbs[h] and cbbs[h].members==cbbs[i].members:
-					cbbs[i].become_pointer(cbbs[h])
-					self.cbbnodes.remove(cbbs[i])
-					self.nodes.remove(cbbs[i])
-					cbbs[i] = None
-					break
+		# merge CBBs with identical member sets (into the first such CBB by name)
+		cbbsbymembers = {}	# frozenset of member nodes -> CBB
+		for cbb in sorted(self.cbbnodes, key=lambda n: n.name):
+			members = frozenset(cbb.members)
+			if members in cbbsbymembers:
+				cbb.become_pointer(cbbsbymembers[members])
+				self.cbbnodes.remove(cbb)
+				self.nodes.remove(cbb)
+			else:
+				cbbsbymembers[members] = cbb
 					
 		assert self.lexnodes
 		
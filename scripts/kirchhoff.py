@@ -2,76 +2,175 @@
 Algorithm for backing off to matrix tree theorem if there are too many
 spanning trees to generate with spanningtree.py.
 
+The determinant is computed exactly: where the count is small enough, as a 
+rounded floating-point determinant, and otherwise modulo several primes by 
+Gaussian elimination (vectorized with NumPy), recovered with the Chinese 
+remainder theorem, so counts are exact however large they get.
+
 @author: Naomi Saphra (nsaphra@andrew.cmu.edu)
 @since: 2013-02-26
 """
 
+import operator
+from collections import defaultdict
 import numpy as np
 
 root_node = "$$"
 
+# counts bounded by this are computed in floating point: the rounding error of 
+# np.linalg.det on these Laplacians stays far below 0.5 (unlike near 2**53)
+FLOAT_EXACT_BOUND = 2**40
+
+def edge_index(G, r):
+    """
+    Number the nodes of G, with the root as 0, and return the number of nodes 
+    along with the (parent, child) index of each edge
+    """
+    inds = {r: 0}
+    edges = []
+    for (parent, child) in G:
+        if parent not in inds:
+            inds[parent] = len(inds)
+        if child not in inds:
+            inds[child] = len(inds)
+        edges.append((inds[parent], inds[child]))
+    return len(inds), edges
+
+def laplacians(indexed, n):
+    """
+    Stack the Laplacian matrices of the edge-indexed graphs in indexed, 
+    each with n nodes, as in laplacian()
+    """
+    batch = [b for b, edges in enumerate(indexed) for _ in edges]
+    parents = [p for edges in indexed for (p, c) in edges]
+    children = [c for edges in indexed for (p, c) in edges]
+    laps = np.zeros((len(indexed), n, n), dtype=np.int64)
+    # degree matrix: one for each incoming edge
+    np.add.at(laps, (batch, children, children), 1)
+    # adjacency matrix (distinct edges only)
+    adj = np.zeros_like(laps)
+    adj[batch, children, parents] = 1
+    return laps - adj
+
 def laplacian(G, r):
     """
     Forms the Laplacian matrix of directed graph G,
     but with edge (parent, child) going from child to parent
     with root node as 0th row and column
     """
-
-    # initialize root_node ind so we know when constructing sink-reduced laplacian
-    inds = {r: 0}
-
-    def set_inds():
-        """
-        Set an index into the matrix for each node
-        """
-        for (parent, child) in G:
-            if parent not in inds:
-                inds[parent] = len(inds)
-            if child not in inds:
-                inds[child] = len(inds)
-
-    def degreemat():
-        """
-        Construct the degree matrix for G
-        """
-        deg = [[0 for row in inds] for col in inds]
-
-        for (parent, child) in G:
-            deg[inds[child]][inds[child]] += 1
-
-        return deg
-
-    def adjacencymat():
-        """
-        Construct the adjacency matrix for G
-        """
-        adj = [[0 for row in inds] for col in inds]
-
-        for (parent, child) in G:
-            adj[inds[child]][inds[parent]] = 1
-        
-        return adj
-
-    set_inds()
-    degree = np.matrix(degreemat())
-    adjacency = np.matrix(adjacencymat())
-    return np.subtract(degree, adjacency)
+    n, edges = edge_index(G, r)
+    return laplacians([edges], n)[0]
+
+_primes = []
+
+def primes():
+    """Large primes below 2**31, in descending order (computed as needed)."""
+    for p in _primes:
+        yield p
+    candidate = _primes[-1]-2 if _primes else 2**31-1
+    while True:
+        if all(candidate % d for d in xrange(3, int(candidate**.5)+1, 2)):
+            _primes.append(candidate)
+            yield candidate
+        candidate -= 2
+
+def inverse_mod(a, p):
+    """Elementwise inverse of the residues a modulo the prime p (0 maps to 0)."""
+    result = np.ones_like(a)
+    base = a.copy()
+    e = p-2
+    while e:
+        if e & 1:
+            result = result * base % p
+        base = base * base % p
+        e >>= 1
+    return result
+
+def det_mod(A, p):
+    """
+    Determinants of a stack of integer matrices A (shape (batch, n, n)) 
+    modulo the prime p (< 2**31, so that products of residues fit in 64 bits), 
+    by Gaussian elimination over GF(p), run on all matrices at once.
+    """
+    A = A % p
+    batch, n = A.shape[:2]
+    det = np.ones(batch, dtype=np.int64)
+    scale = np.ones(batch, dtype=np.int64)
+    pivotproduct = np.ones(batch, dtype=np.int64)
+    rows = np.arange(batch)
+    for k in xrange(n):
+        # pivot on the first nonzero entry in column k (a zero column leaves the pivot, and so det, zero)
+        i = k + np.argmax(A[:,k:,k] != 0, axis=1)
+        det[i != k] = p - det[i != k]
+        pivotrows = A[rows,i].copy()
+        A[rows,i] = A[:,k]
+        A[:,k] = pivotrows
+        pivots = A[:,k,k]
+        det = det * pivots % p
+        # eliminate without division: scaling each remaining row by the pivot 
+        # multiplies the determinant by pivot**(n-k-1). The product of these 
+        # factors is the product of the running pivot products, divided out at the end
+        A[:,k+1:,k:] = (A[:,k+1:,k:] * pivots[:,None,None] % p
+                        - A[:,k+1:,k,None] * A[:,None,k,k:] % p) % p
+        pivotproduct = pivotproduct * pivots % p
+        if k < n-1:
+            scale = scale * pivotproduct % p
+    return det * inverse_mod(scale, p) % p
+
+def det_nonnegative(A, bounds):
+    """
+    Exact determinants of a stack of integer matrices A, given that 
+    the ith determinant lies in [0, bounds[i]].
+    """
+    residues, modulus = [0]*len(A), 1
+    for p in primes():
+        if modulus > max(bounds):
+            return residues
+        dets = det_mod(A, p)
+        # Chinese remainder theorem: combine each residue (mod modulus) with its det (mod p)
+        inv = pow(modulus, p-2, p)
+        residues = [residue + modulus * ((int(d) - residue) * inv % p) for residue, d in zip(residues, dets)]
+        modulus *= p
+
+def spanningtree_counts(Gs, r):
+    """
+    Compute the number of directed spanning trees of each graph in Gs
+    using Kirchhoff's matrix tree theorem for directed graphs. 
+    Graphs are grouped by size so that the determinants for each size 
+    are computed together.
+    """
+    counts = [None]*len(Gs)
+    bysize = defaultdict(list)
+    for i, G in enumerate(Gs):
+        n, edges = edge_index(G, r)
+        bysize[n].append((i, edges))
+
+    for n, group in bysize.items():
+        inds, indexed = zip(*group)
+        sink_reduced_laplaces = laplacians(indexed, n)[:,1:,1:]
+        # each tree picks one parent per node, so the count is at most the product of in-degrees
+        bounds = [reduce(operator.mul, map(int, degs), 1) for degs in np.diagonal(sink_reduced_laplaces, axis1=1, axis2=2)]
+        small = np.array([bound < FLOAT_EXACT_BOUND for bound in bounds], dtype=bool)
+        if small.any():
+            dets = np.linalg.det(sink_reduced_laplaces[small].astype(np.float64)) if n > 1 else np.ones(small.sum())
+            for i, det in zip(np.array(inds)[small], dets):
+                counts[i] = int(round(det))
+        if not small.all():
+            large = ~small
+            for i, det in zip(np.array(inds)[large], det_nonnegative(sink_reduced_laplaces[large], [b for b, s in zip(bounds, small) if not s])):
+                counts[i] = det
+    return counts
 
 def spanningtree(G, r):
     """
     Compute the number of directed spanning trees of G
     using Kirchhoff's matrix tree theorem for directed graphs.
     """
-
-    laplace = laplacian(G, r)
-    #print(np.delete(laplace, 0, 0), file=sys.stderr)
-    sink_reduced_laplace = np.delete(np.delete(laplace, (0), axis=0),
-                                     (0), axis=1)
-    return int(round(np.linalg.det(sink_reduced_laplace)))	# not converting to an int could cause numerical problems later!
+    return spanningtree_counts([G], r)[0]
 
 def test():
     def assert_good_result(G, r):
-        assert spanningtree(G, r) == len(spanningtree.spanning(G, r))
+        assert spanningtree(G, r) == len(spanningtrees.spanning(G, r))
 
     import spanningtrees
     a = "a"
@@ -95,3 +194,20 @@ def test():
     #  |---^   
     #      
     assert_good_result(g1, root_node)
+
+    # complete graph on n nodes plus the root: Cayley's formula gives (n+1)**(n-1) trees,
+    # far more than a floating-point determinant can represent exactly
+    n = 40
+    nodes = [root_node] + range(n)
+    g2 = [(u,v) for u in nodes for v in range(n) if u != v]
+    assert spanningtree(g2, root_node) == (n+1)**(n-1)
+
+    # counts on either side of FLOAT_EXACT_BOUND (bounded by 11**11 and 12**12) are exact
+    for n in (11, 12):
+        nodes = [root_node] + range(n)
+        g = [(u,v) for u in nodes for v in range(n) if u != v]
+        assert spanningtree(g, root_node) == (n+1)**(n-1)
+
+    # batched counts agree with one-at-a-time counts
+    g3 = [(root_node,a), (root_node,b), (a,b), (b,a)]
+    assert spanningtree_counts([g1, g2, g3, g1], root_node) == [spanningtree(g, root_node) for g in (g1, g2, g3, g1)]
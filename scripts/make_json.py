@@ -8,28 +8,272 @@ SentenceID TAB SpaceSepTokens TAB {ParseGraphAsJson}
 
 E.g.:
   scripts/make_json.py anno/tweets/dev.0000.anno
+  scripts/make_json.py -j 8 anno/tweets/*.anno
+
+Annotations are parsed with gfl_parser.DirectParser, whose output is identical
+to the ANTLR parser's; with --peg, they are parsed with the PEG grammar of
+gflparser/ instead (GFLPegParser), which accepts only GFL 1.0.
+
+With -j/--jobs N, containers are parsed in N worker processes; output order is
+the same as the serial mode. With -b/--binary, the output is in the binary form
+of fudg_binary.py instead. With -c/--cache DIR, parses are cached on disk
+(see gfl_parser.ParseCache), so that reconverting a directory after editing a
+few files only reparses the annotations that changed.
+
+With --sync OUTPUT, the arguments are directories (or files) whose .anno files
+are kept converted in OUTPUT: a manifest (OUTPUT.manifest) records each file's
+size, modification time and hash and where its lines are in OUTPUT, so only
+files that changed since the last sync are reconverted, and the lines of the
+others are copied over from the previous OUTPUT. E.g.:
+  scripts/make_json.py -j 8 --sync anno.json anno/
+
+With --test, runs the self-tests.
 
 ... It may be desirable to use ID information contained in other parts of the
 container, but I guess we'll use filenames for now...
 """
-import sys,re,os
+import sys,re,os,collections,itertools,multiprocessing,hashlib,imp
 try:
   import ujson as json
 except ImportError:
   import json
 import view
 import gfl_parser
+import fudg_binary
+
+session = gfl_parser.GFLParserSession(backend='direct')
+cache = None  # a gfl_parser.ParseCache, if set
+peg = None  # a GFLPegParser, if set
+
+def containers(filenames):
+  """yield (sentence_id, tokens, code) for every annotated container"""
+  for filename in filenames:
+    # containers are read as they are needed, so large files are converted in constant memory
+    tokens_codes_annos = view.iter_containers(filename)
+    first_two = list(itertools.islice(tokens_codes_annos, 2))
+    doc_id = re.sub(r'\.(anno|txt)$','', filename)
+
+    for i,(tokens,code,anno,lines) in enumerate(itertools.chain(first_two, tokens_codes_annos)):
+      if not code: continue
+      sentence_id = doc_id
+      if len(first_two)>1: sentence_id += ':' + str(i)
+      yield sentence_id, tokens, code
+
+def to_fudg(item):
+  """(sentence_id, space-separated tokens, FUDG JSON object) for a container"""
+  sentence_id, tokens, code = item
+  if peg:
+    parse = peg.parse(code, tokens)
+  elif cache:
+    parse = cache.parse(tokens, code, session=session)
+  else:
+    parse = session.parse(tokens,code)
+  return sentence_id, ' '.join(tokens), parse.to_json()
+
+def convert(item):
+  sentence_id, tokens, parseJ = to_fudg(item)
+  return u"{id}\t{tokens}\t{parse}".format(id=sentence_id, tokens=tokens, parse=json.dumps(parseJ))
+
+def convert_parallel(items, jobs, window_per_job=64, convert=convert):
+  """
+  Like itertools.imap(convert, items), but over a pool of worker processes.
+  At most jobs*window_per_job containers are in flight, so neither the input
+  nor the output of a large corpus is held in memory, and results come back
+  in input order.
+  """
+  pool = multiprocessing.Pool(jobs)
+  try:
+    pending = collections.deque()
+    for item in items:
+      pending.append(pool.apply_async(convert, (item,)))
+      if len(pending) >= jobs*window_per_job:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+    pool.close()
+  finally:
+    pool.terminate()
+
+def convert_file(filename):
+  """the FUDG JSON lines for a file's containers, as one UTF-8 string"""
+  lines = [convert(item) for item in containers([filename])]
+  return ''.join(line.encode('utf8') + '\n' for line in lines)
+
+def anno_files(paths):
+  """the .anno files under the given directories (and any other files given), sorted"""
+  filenames = []
+  for path in paths:
+    if not os.path.isdir(path):
+      filenames.append(path)
+      continue
+    for dirpath, dirnames, names in os.walk(path):
+      filenames.extend(os.path.join(dirpath, name) for name in names if name.endswith('.anno'))
+  return sorted(filenames)
+
+def file_sha1(filename):
+  with open(filename, 'rb') as inF:
+    return hashlib.sha1(inF.read()).hexdigest()
+
+MANIFEST_HEADER = '#make_json manifest'
+
+def read_manifest(outname):
+  """
+  {filename: (size, mtime, sha1, offset, length)} from outname's manifest,
+  or {} if there is none or it is stale (the output has changed since, or
+  was made by a different version of the parser).
+  """
+  manifestname = outname+'.manifest'
+  if not (os.path.exists(manifestname) and os.path.exists(outname)):
+    return {}
+  entries = {}
+  with open(manifestname) as inF:
+    if inF.readline().rstrip('\n') != '{}\t{}\t{}'.format(MANIFEST_HEADER, gfl_parser.parser_version(), os.path.getsize(outname)):
+      return {}
+    for line in inF:
+      filename, size, mtime, sha1, offset, length = line.rstrip('\n').split('\t')
+      entries[filename] = (int(size), float(mtime), sha1, int(offset), int(length))
+  return entries
+
+def sync(paths, outname, jobs=1):
+  """
+  Bring outname up to date with the .anno files under paths, reconverting
+  only the files that changed since the last sync. Returns the numbers of
+  files reconverted and in total.
+  """
+  old = read_manifest(outname)
+  filenames = anno_files(paths)
+  stats, changed = {}, []
+  for filename in filenames:
+    st = os.stat(filename)
+    stats[filename] = (st.st_size, st.st_mtime)
+    if filename in old and old[filename][:2] == stats[filename]:
+      continue
+    sha1 = file_sha1(filename)
+    if filename in old and old[filename][2] == sha1:  # touched but not modified
+      old[filename] = stats[filename] + old[filename][2:]
+      continue
+    stats[filename] += (sha1,)
+    changed.append(filename)
+
+  if jobs > 1:
+    converted = dict(zip(changed, convert_parallel(changed, jobs, convert=convert_file)))
+  else:
+    converted = {filename: convert_file(filename) for filename in changed}
+
+  # splice the new lines in among the old ones, writing to temporary files
+  # so that an interrupted sync leaves the previous output and manifest intact
+  manifest = []
+  offset = 0
+  oldF = open(outname, 'rb') if old else None
+  with open(outname+'.tmp', 'wb') as outF:
+    for filename in filenames:
+      if filename in converted:
+        lines = converted[filename]
+        sha1 = stats[filename][2]
+      else:
+        sha1, oldoffset, length = old[filename][2:]
+        oldF.seek(oldoffset)
+        lines = oldF.read(length)
+      outF.write(lines)
+      manifest.append((filename,) + stats[filename][:2] + (sha1, offset, len(lines)))
+      offset += len(lines)
+  if oldF: oldF.close()
+  with open(outname+'.manifest.tmp', 'w') as outF:
+    outF.write('{}\t{}\t{}\n'.format(MANIFEST_HEADER, gfl_parser.parser_version(), offset))
+    for filename, size, mtime, sha1, offset, length in manifest:
+      outF.write('{}\t{}\t{!r}\t{}\t{}\t{}\n'.format(filename, size, mtime, sha1, offset, length))
+  os.rename(outname+'.tmp', outname)
+  os.rename(outname+'.manifest.tmp', outname+'.manifest')
+  return len(changed), len(filenames)
+
+def test():
+  import tempfile, shutil
+  here = os.path.dirname(os.path.abspath(__file__))
+  tmpdir = tempfile.mkdtemp()
+  try:
+    src = os.path.join(tmpdir, 'anno')
+    os.makedirs(os.path.join(src, 'tweets'))
+    for name in ['bonds.anno', 'arabic.anno'] + ['tweets/dev.000{}.anno'.format(i) for i in range(4)]:
+      shutil.copy(os.path.join(here, '../anno', name), os.path.join(src, name))
+    out = os.path.join(tmpdir, 'anno.json')
+    def full():
+      return ''.join(convert_file(filename) for filename in anno_files([src]))
+    def output():
+      with open(out, 'rb') as inF:
+        return inF.read()
+
+    # -j output matches the serial output line for line, also when the window is full
+    items = list(containers(anno_files([src])))
+    serial = [convert(item) for item in items]
+    for window_per_job in (1, 64):
+      assert list(convert_parallel(items, 3, window_per_job)) == serial
+
+    for jobs in (1, 3):
+      for name in (out, out+'.manifest'):
+        if os.path.exists(name): os.remove(name)
+      nfiles = len(anno_files([src]))
+      assert sync([src], out, jobs) == (nfiles, nfiles)
+      assert output() == full()
+      # nothing changed, or only the modification time
+      assert sync([src], out, jobs) == (0, nfiles)
+      edited = os.path.join(src, 'bonds.anno')
+      os.utime(edited, (0, 0))
+      assert sync([src], out, jobs) == (0, nfiles)
+      assert output() == full()
+      # an edited file is reconverted, and its lines replaced in place
+      shutil.copy(os.path.join(src, 'tweets/dev.0000.anno'), edited)
+      os.utime(edited, (1, 1))
+      assert sync([src], out, jobs) == (1, nfiles)
+      assert output() == full()
+      shutil.copy(os.path.join(here, '../anno/bonds.anno'), edited)
+      assert sync([src], out, jobs) == (1, nfiles)
+      # a removed file's lines are dropped
+      removed = os.path.join(src, 'tweets/dev.000{}.anno'.format(jobs))
+      os.remove(removed)
+      assert sync([src], out, jobs) == (0, nfiles-1)
+      assert output() == full()
+      shutil.copy(os.path.join(here, '../anno/tweets', os.path.basename(removed)), removed)
+  finally:
+    shutil.rmtree(tmpdir)
 
-args = sys.argv[1:]
-for filename in args:
-  tokens_codes_annos = view.process_potentially_multifile(filename)
-  doc_id = re.sub(r'\.(anno|txt)$','', filename)
+if __name__=='__main__':
+  from optparse import OptionParser
+  p = OptionParser(usage="%prog [-j N] [-b] [-c DIR] files...\n       %prog [-j N] [-c DIR] --sync OUTPUT dirs...")
+  p.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help="number of worker processes")
+  p.add_option('-b', '--binary', dest='binary', action='store_true', help="write the binary format of fudg_binary.py")
+  p.add_option('-c', '--cache', dest='cache', help="directory for cached parses")
+  p.add_option('--cache-mb', dest='cache_mb', type='int', default=256, help="cache size limit in megabytes (default 256)")
+  p.add_option('--peg', dest='peg', action='store_true', help="parse with the PEG grammar (gflparser/gfl1.peg)")
+  p.add_option('--sync', dest='sync', metavar='OUTPUT', help="update OUTPUT from the .anno files under the given directories, reconverting only changed files")
+  p.add_option('--test', dest='test', action='store_true', help="run the self-tests")
+  opts,args = p.parse_args()
 
-  for i,(tokens,code,anno) in enumerate(tokens_codes_annos):
-    if not code: continue
-    sentence_id = doc_id
-    if len(tokens_codes_annos)>1: sentence_id += ':' + str(i)
-    parse = gfl_parser.parse(tokens,code)
-    parseJ = parse.to_json()
-    print "{id}\t{tokens}\t{parse}".format(id=sentence_id, tokens=' '.join(tokens), parse=json.dumps(parseJ))
+  if opts.test:
+    test()
+    sys.exit(0)
 
+  if opts.peg:
+    assert not (opts.cache or opts.sync), "--peg does not combine with --cache or --sync"
+    gflparser = imp.load_source('gflparser', os.path.join(os.path.dirname(os.path.abspath(__file__)), '../gflparser/parser.py'))
+    peg = gflparser.GFLPegParser()
+  if opts.cache:
+    cache = gfl_parser.ParseCache(opts.cache, max_bytes=opts.cache_mb*2**20)
+  if opts.sync:
+    assert not opts.binary, "--sync only writes FUDG JSON"
+    nchanged, nfiles = sync(args, opts.sync, opts.jobs)
+    print >>sys.stderr, "reconverted {} of {} files".format(nchanged, nfiles)
+    sys.exit(0)
+  items = containers(args)
+  f = to_fudg if opts.binary else convert
+  if opts.jobs > 1:
+    results = convert_parallel(items, opts.jobs, convert=f)
+  else:
+    results = (f(item) for item in items)
+  if opts.binary:
+    writer = fudg_binary.Writer(sys.stdout)
+    utf8 = lambda s: s.encode('utf8') if isinstance(s,unicode) else s
+    for sentence_id, tokens, parseJ in results:
+      writer.write(utf8(sentence_id), utf8(tokens), parseJ)
+  else:
+    for line in results:
+      print line.encode('utf8')
@@ -8,9 +8,10 @@ import os, re, sys, fileinput, json, math
 from collections import Counter, defaultdict
 
 from graph import FUDGGraph, LexicalNode, simplify_coord, upward, downward
-from spanningtrees import spanning
-from kirchhoff import spanningtree
+from spanningtrees import spanning, iter_spanning
+from kirchhoff import spanningtree, spanningtree_counts
 from merge_annotations import *
+from fudg_json import records
 
 class ValueStats(object):
 	def __init__(self, val=None, show=None):
@@ -81,52 +82,69 @@ def com(prom, N):
 	assert 0.0<=com<=1.0,(com,prom,N)
 	return com
 
-def promcom(a, c, kirchhoff=False):
+def kirchhoff_promcom(stg, N, c, prom):
+	c['spanning trees'] = ValueStats(prom)
+	if prom==0:
+		raise Exception('No spanning trees for: '+repr(stg))
+	c['promiscuity'] = ValueStats(prom)
+	assert N>=2
+	c['commitment'] = ValueStats(com(prom,N), show='mean')
+
+def kirchhoff_promcoms(pending):
+	'''Fill in the counters deferred by promcom(), counting the spanning trees of all their graphs at once.'''
+	proms = spanningtree_counts([stg for stg,N,c in pending], '$$')
+	for (stg,N,c),prom in zip(pending, proms):
+		kirchhoff_promcom(stg, N, c, prom)
+
+def promcom(a, c, kirchhoff=False, pending=None):
 	stg = {(p.name,n.name) for n in a.lexnodes for p in n.parentcandidates}
 	#stg = {(p.name,n.name) for n in a.nodes-{a.root} for ch in (n.topcandidates if n.isCBB else {n.name}) for p in n.parentcandidates}
 	assert any(1 for x,y in stg if x=='$$'),('The root $$ is not in the graph!',stg)
 
 	if kirchhoff:	# approximate promiscuity: count spanning trees with matrix tree theorem (instead of enumerating them). an upper bound.
-		prom = spanningtree(stg, '$$')
-		c['spanning trees'] = ValueStats(prom)
-		if prom==0:
-			raise Exception('No spanning trees for: '+repr(stg))
-		c['promiscuity'] = ValueStats(prom)
 		N = len(a.lexnodes)+1
-		assert N>=2
-		c['commitment'] = ValueStats(com(prom,N), show='mean')
+		if pending is not None:	# count later, in one batch with other sentences (see kirchhoff_promcoms())
+			pending.append((stg, N, c))
+			return
+		kirchhoff_promcom(stg, N, c, spanningtree(stg, '$$'))
 		return
 
-	def compatible_analyses(spanning_trees, nodeswithext):
-		for analysis in spanning_trees:
-			parmap = parentmap(analysis)
-			#assert False,parmap
-			violation = False
+	def is_compatible(nodes, par, nodeswithext):
+		'''Whether a spanning tree from iter_spanning() is a compatible analysis.'''
+		if not nodeswithext:	# no constraints to check
+			return True
+		parmap = dict(zip(nodes[1:], map(nodes.__getitem__, par[1:])))
+		#assert False,parmap
+		violation = False
 
-			# determine tops of all CBBs in this analysis, going upward
-			tops = {}
-			for cbb in sorted(a.cbbnodes, key=lambda node: node.height):
-				assert cbb.members,(cbb,cbb._pointerto)
-				tops[cbb.name] = min((tops.get(n.name,n.name) for n in cbb.members), key=lambda v: depth(v,parmap))
+		# determine tops of all CBBs in this analysis, going upward
+		tops = {}
+		for cbb in sorted(a.cbbnodes, key=lambda node: node.height):
+			assert cbb.members,(cbb,cbb._pointerto)
+			tops[cbb.name] = min((tops.get(n.name,n.name) for n in cbb.members), key=lambda v: depth(v,parmap))
 
-			for cbb in nodeswithext:
-				top = tops[cbb.name]
-				for x in cbb.externalchildren:
-					if (parmap.get(x.name) or parmap[tops[x.name]])!=top:
-						violation = True
-						#if 'tix' in a.alltokens:
-						#	assert False,(tops,x.name,parmap.get(x.name) or parmap[tops[x.name]],top,analysis)
-						break
-				if violation: break
-			if not violation:
-				yield analysis
+		for cbb in nodeswithext:
+			top = tops[cbb.name]
+			for x in cbb.externalchildren:
+				if (parmap.get(x.name) or parmap[tops[x.name]])!=top:
+					violation = True
+					#if 'tix' in a.alltokens:
+					#	assert False,(tops,x.name,parmap.get(x.name) or parmap[tops[x.name]],top,analysis)
+					break
+			if violation: break
+		return not violation
 	
 	try:
-		strees = spanning(stg, '$$', threshold=10000)
-		assert len(strees)>0
-		c['spanning trees'] = ValueStats(len(strees))
+		# stream the spanning trees, counting them and the compatible analyses among them
 		nodeswithext = {cbb for cbb in a.cbbnodes if cbb.externalchildren}
-		prom = sum(1 for t in compatible_analyses(strees, nodeswithext))
+		ntrees = prom = 0
+		for nodes,par in iter_spanning(stg, '$$'):
+			ntrees += 1
+			if ntrees > 10000:
+				raise Exception('Too many spanning trees.')
+			prom += is_compatible(nodes, par, nodeswithext)
+		assert ntrees>0
+		c['spanning trees'] = ValueStats(ntrees)
 		assert prom>0,'No compatible trees for sentence: '+' '.join(a.alltokens)
 		c['promiscuity'] = ValueStats(prom)
 		N = len(a.lexnodes)+1
@@ -243,7 +261,7 @@ def iapromcom(a1, a2, c, escapebrackets=False, kirchhoff=False):
 		c['no_valid_merge'] = 1
 	
 
-def single_ann_measures(a, kirchhoff=False):
+def single_ann_measures(a, kirchhoff=False, pending=None):
 	c = Counter()
 	c['lexnodes'] = len(a.lexnodes)
 	c['1W'] = sum(1 for n in a.lexnodes if len(n.tokens)==1)
@@ -265,7 +283,7 @@ def single_ann_measures(a, kirchhoff=False):
 	upward(a)
 	downward(a)
 	c['possible utterance heads'] = sum(int(a.root in n.parentcandidates) for n in a.lexnodes)
-	promcom(a,c, kirchhoff=kirchhoff)
+	promcom(a,c, kirchhoff=kirchhoff, pending=pending)
 
 	return c
 	
@@ -277,21 +295,26 @@ def iaa_measures(a1,a2, escapebrackets=False, kirchhoff=False):
 def main(anns1F, anns2F=None, verbose=False, escapebrackets=False, kirchhoff=False):
 	i = 0
 	a1C, a2C, iaC = Counter(), Counter(), Counter()
-	for ann1ln in anns1F:
-		if not ann1ln.strip(): continue
-		loc1, sent, ann1JS = ann1ln[:-1].split('\t')
-		ann1J = json.loads(ann1JS)
-		if verbose: print(i, loc1, '<<', sent)
+	batch = kirchhoff and anns2F is None	# count spanning trees for all sentences at once, at the end
+	pending, singles = [], []
+	recs2 = records(anns2F) if anns2F is not None else None
+	for rec1 in records(anns1F):
+		if rec1 is None: continue
+		loc1, sent, ann1J = rec1.locator, rec1.sentence, rec1.graph
+		if verbose and not batch: print(i, loc1, '<<', sent)
 		a1 = FUDGGraph(ann1J)
+		if batch:
+			singles.append((i, loc1, sent, single_ann_measures(a1, kirchhoff=kirchhoff, pending=pending)))
+			i += 1
+			continue
 		a1single = single_ann_measures(a1, kirchhoff=kirchhoff)
 		a1C += a1single
 		if verbose: print('   ',a1single)
 		if anns2F is not None:
-			ann2ln = next(anns2F)
-			if not ann2ln.strip(): continue
-			loc2, sent2, ann2JS = ann2ln[:-1].split('\t')
+			rec2 = next(recs2)
+			if rec2 is None: continue
+			loc2, sent2, ann2J = rec2.locator, rec2.sentence, rec2.graph
 			#assert sent2==sent,(sent,sent2)
-			ann2J = json.loads(ann2JS)
 			assert len(ann1J['tokens'])==len(ann2J['tokens'])
 			#assert ann1J['tokens']==ann2J['tokens'],(ann1J['tokens'],ann2J['tokens'])
 			a2 = FUDGGraph(ann2J)
@@ -303,6 +326,13 @@ def main(anns1F, anns2F=None, verbose=False, escapebrackets=False, kirchhoff=Fal
 			iaC += iaa
 			if verbose: print('   ',iaa)
 		i += 1
+	if batch:
+		kirchhoff_promcoms(pending)
+		for i, loc1, sent, a1single in singles:
+			if verbose:
+				print(i, loc1, '<<', sent)
+				print('   ',a1single)
+			a1C += a1single
 	if verbose: print()
 	print(a1C)
 	if a2C:
@@ -15,6 +15,7 @@ from collections import Counter, defaultdict
 from graph import FUDGGraph, simplify_coord, upward, downward
 from spanningtrees import spanning
 from measures import *
+from fudg_json import records
 
 def mw2CBBMW(ann, n):
 	'''Given the JSON object for an annotation and the name of a MW node, convert it to a CBBMW node'''
@@ -265,16 +266,17 @@ def main(annsFF, verbose=False, simplifycoords=False, updatelex=False, escapebra
 	
 	i = 0
 	allC = Counter()
+	recsFF = [records(annsF) for annsF in annsFF]
 	while True:	# iterate over items
 		annsJ = []	# JSON input objects, one per annotator
 		anns = []	# FUDG graphs, one per annotator
 		locs = []
 		
 		try:
-			for j,annsF in enumerate(annsFF):	# iterate over annotators
+			for j,recsF in enumerate(recsFF):	# iterate over annotators
 				#print('.',j,file=sys.stderr)
-				ln = next(annsF)
-				loc, sent, annJS = ln[:-1].split('\t')
+				rec = next(recsF)
+				loc, sent = rec.locator, rec.sentence
 				locs.append(loc)
 				if j==0:
 					sent0 = sent
@@ -285,7 +287,7 @@ def main(annsFF, verbose=False, simplifycoords=False, updatelex=False, escapebra
 					print(ex, file=sys.stderr)
 
 				
-				annJ = json.loads(annJS)
+				annJ = rec.graph
 				annsJ.append(annJ)
 				if verbose:
 					print(i, loc, '<<', sent, file=sys.stderr)
@@ -8,98 +8,115 @@ of Uno 1996. The graph is encoded as a set of edge tuples.
 '''
 
 from graph import FUDGGraph
-import copy
-
-def find_tail(T, tail):
-    for (u,v) in T:
-        if v == tail:
-            return (u,v)
-    return None
-
-def find_head(T, head):
-    edges = []
-    for (u,v) in T:
-        if u == head:
-            edges.append((u,v))
-    return edges
-
-def dfs(G, r):
+from collections import defaultdict
+import itertools
+
+def index_edges(G):
+    """
+    Returns (children, parents): for each node, the nodes it has edges to and 
+    the nodes it has edges from, in the order the edges are listed in G.
+    """
+    children = defaultdict(list)
+    parents = defaultdict(list)
+    for (u,v) in G:
+        children[u].append(v)
+        parents[v].append(u)
+    return (children, parents)
+
+def dfs(children, r):
+    """
+    Depth-first spanning tree from r, as a map from each node to its parent, 
+    and the order in which nodes were visited.
+    """
     inds = {r:0}
-    ind = 0
-    edges = set()
+    par = {}
 
-    trail = []
-    trail += find_head(G, r)
+    trail = [(r,v) for v in children[r]]
     while (len(trail)):
         (u,v) = trail.pop()
         if v in inds:
             continue
 
-        edges.add((u,v))
-        ind += 1
-        inds[v] = ind
-        trail += find_head(G, v)
-
-    return (edges, inds)
-
-def ancestors(start, G, root):
-    anc = set([start])
-    curr = start
-    while curr != root:
-        (u,v) = find_tail(G, curr)
-        assert v == curr
-        anc.add(u)
-        curr = u
-    return anc
-
-def spanning(G, r, threshold=20000):
-    (T0, inds) = dfs(G, r)
-    trees = [T0]
-
-    def getkey(x):
-        u,v = x
-        return inds[v]
-
-    def min_ind(T):
-        min = 0
-        for (u,v) in T:
-            if not min or inds[v] < min:
-                min = inds[v]
-        return min
-
-    def get_nonbacks(T, is_T0=False):
+        par[v] = u
+        inds[v] = len(inds)
+        trail.extend((v,w) for w in children[v])
+
+    return (par, inds)
+
+def iter_spanning(G, r):
+    """
+    Generates the spanning trees of G rooted at r one at a time, in the 
+    same order as spanning(), so that callers can filter or count them 
+    without holding them all in memory, and can stop early.
+
+    Yields (nodes, par) pairs. nodes is the list of nodes in depth-first 
+    order (nodes[0] is r) and is the same for every tree. par is a parent 
+    array: par[i] is the index in nodes of the parent of nodes[i] (-1 for r). 
+    par is updated in place to produce the next tree, so copy it to keep it.
+    """
+    (children, parents) = index_edges(G)
+    (par0, inds) = dfs(children, r)
+    if len(inds) < len(set(children) | set(parents) | {r}):
+        raise Exception("Some nodes are not reachable from the root.")
+    nodes = sorted(inds, key=inds.get)
+    par = [-1] + [inds[par0[v]] for v in nodes[1:]]
+    heads = [[inds[u] for u in parents[v]] for v in nodes]
+
+    def get_nonbacks(min):
+        """
+        Edges (as index pairs) not in the current tree that would not create 
+        a cycle, whose tails precede index min, ordered by tail index.
+        """
         nonback = []
-        min = min_ind(T0 - T)
-
-        for (head, tail) in G:
-            if (head, tail) in T:
-                continue
-            if not is_T0 and inds[tail] >= min:
-                continue
-        
-            if tail not in ancestors(head, T, r):
-                nonback.append((head, tail))
-
-        nonback.sort(key=getkey)
+        for tail in xrange(1, min):
+            for head in heads[tail]:
+                if par[tail] == head:
+                    continue
+                # is tail an ancestor of head (or head itself)?
+                x = head
+                while x != tail and x != 0:
+                    x = par[x]
+                if x != tail:
+                    nonback.append((head, tail))
         return nonback
 
-    def spanning_iter(T, nonback, lvl=0):
+    yield (nodes, par)
+
+    # Uno's recursion, with an explicit stack: each frame holds the remaining 
+    # non-back edges for a tree, and the swap to undo when it is exhausted
+    stack = [(iter(get_nonbacks(len(nodes))), None)]
+    while stack:
+        (nonback, undo) = stack[-1]
+        for (u,v) in nonback:
+            e = par[v]
+            par[v] = u
+            yield (nodes, par)
+            # the smallest index of a node whose parent differs from T0 is now v
+            stack.append((iter(get_nonbacks(v)), (v, e)))
+            break
+        else:
+            stack.pop()
+            if undo is not None:
+                (v, e) = undo
+                par[v] = e
+
+def spanning(G, r, threshold=20000):
+    trees = []
+    for (nodes, par) in iter_spanning(G, r):
+        trees.append(set(zip(map(nodes.__getitem__, par[1:]), nodes[1:])))
         if len(trees) > threshold:
             raise Exception("Too many spanning trees.")
-
-        for f in nonback:
-            u,v = f
-            e = find_tail(T, v)
-            Tc = copy.copy(T)
-            Tc.add(f)
-            Tc.remove(e)
-            trees.append(Tc)
-
-            Tc_nonback = get_nonbacks(Tc)
- 
-            spanning_iter(Tc, Tc_nonback, lvl+1)
-
-    nonback = get_nonbacks(T0, is_T0=True)
-    spanning_iter(T0, nonback)
     return trees
 
+def test():
+    r = "$$"
+    G = {(r,"d"), ("d","c"), ("d","e"), ("e","a"), ("e","b"), ("b","e"), ("b","a"), ("c","b")}
+    trees = spanning(G, r)
+    streamed = [set((nodes[p], nodes[i]) for i,p in enumerate(par) if p >= 0) for (nodes, par) in iter_spanning(G, r)]
+    assert streamed == trees
+    assert len(set(frozenset(T) for T in trees)) == len(trees) == 6
+    # stopping early
+    assert len(list(itertools.islice(iter_spanning(G, r), 2))) == 2
+
+if __name__=='__main__':
+    test()
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 # vim:sts=4:sw=4
 from __future__ import division
-import re,sys,os,traceback,itertools,json,codecs
-from collections import defaultdict
+import re,sys,os,string,traceback,itertools,json,codecs,subprocess,multiprocessing,hashlib,tempfile,struct
+from collections import defaultdict, deque
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../parser'))
 import gfl_parser
+import fudg_json
 
 show_words = False
 
@@ -121,8 +122,13 @@ def psf2dot(parse):
     s = '\n'.join(L+';' for L in G)
     return 'digraph {\n %s \n}' % s
 
-def print_html(out, anno_text, png):
-    img = '' if not png else "<img src={}>".format(os.path.basename(png))
+def print_html(out, anno_text, png, htmldir=None):
+    # images are linked relative to the HTML file's directory (htmldir) if given
+    if not png:
+        img = ''
+    else:
+        src = os.path.basename(png) if htmldir is None else os.path.relpath(png, htmldir or '.')
+        img = "<img src={}>".format(src)
     print>>out, u"""
     <hr>
     <pre>{anno_text}</pre>
@@ -150,15 +156,127 @@ def print_header(out):
     <body>
     """
 
-def draw(p, base):
+class DotBatch(object):
+    """
+    One dot process rendering several graphs (DOT sources) to images in the
+    given format ('png' or 'svg'). dot writes one image after another to its
+    output, which is split up and written to imgfilenames by finish().
+    """
+    def __init__(self, dots, imgfilenames, fmt='png'):
+        self.dots, self.imgfilenames, self.fmt = dots, imgfilenames, fmt
+        self.results = None
+        for imgfilename in imgfilenames:
+            print "dot -T{} > {}".format(fmt, imgfilename)
+        self.outF = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(['dot', '-T'+fmt], stdin=subprocess.PIPE, stdout=self.outF)
+        except OSError as e:
+            raise OSError("could not run dot (is GraphViz installed?): {}".format(e))
+        self.proc.stdin.write(''.join(dots))
+        self.proc.stdin.close()
+
+    def finish(self):
+        """Wait for dot, returning the image filenames (None where rendering failed)."""
+        if self.results is not None:
+            return self.results
+        status = self.proc.wait()
+        self.outF.seek(0)
+        images = split_images(self.outF.read(), self.fmt)
+        self.outF.close()
+        # dot's output is only trusted if it exited cleanly and wrote one image per graph
+        if status != 0 or len(images) != len(self.dots):
+            if len(self.dots) == 1:
+                print >>sys.stderr, "dot failed to render", self.imgfilenames[0], "(exit status {})".format(status)
+                self.results = [None]
+                return self.results
+            # one bad graph spoils the batch: render each graph on its own
+            self.results = [DotBatch([dot], [imgfilename], self.fmt).finish()[0]
+                            for dot,imgfilename in zip(self.dots, self.imgfilenames)]
+            return self.results
+        for imgfilename,image in zip(self.imgfilenames, images):
+            # write to a temporary file first so that a cached image is never partial
+            fd, tmpfilename = tempfile.mkstemp(suffix='.'+self.fmt, dir=os.path.dirname(imgfilename) or '.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image)
+            os.rename(tmpfilename, imgfilename)
+        self.results = list(self.imgfilenames)
+        return self.results
+
+def split_images(data, fmt):
+    """Split dot's output for several graphs into one image per graph (dropping a truncated last one)."""
+    images = []
+    start = 0
+    if fmt == 'svg':
+        while True:
+            end = data.find('</svg>', start)
+            if end < 0: break
+            end += len('</svg>')
+            if data[end:end+1] == '\n': end += 1
+            images.append(data[start:end])
+            start = end
+        return images
+    # PNG: a signature, then chunks (length, type, data, CRC) up to IEND
+    while start < len(data):
+        pos = start+8
+        while pos+8 <= len(data):
+            (length,) = struct.unpack_from('>I', data, pos)
+            typ = data[pos+4:pos+8]
+            pos += 12+length
+            if typ == 'IEND': break
+        else:
+            break
+        if pos > len(data): break
+        images.append(data[start:pos])
+        start = pos
+    return images
+
+def draw(p, base, fmt='png'):
     # base is for OUTPUT
-    dot = psf2dot(p)
-    with open("{base}.dot".format(**locals()),'w') as f: print>>f, dot
-    imgfilename = '{base}.png'.format(base=base)
-    cmd = "dot -Tpng < {base}.dot > {imgfilename}".format(**locals())
-    print cmd
-    os.system(cmd)
-    return imgfilename
+    imgfilename = '{base}.{fmt}'.format(**locals())
+    return DotBatch([psf2dot(p)+'\n'], [imgfilename], fmt).finish()[0]
+
+def draw_all(items, jobs, cachedir=None, fmt='png', batch=1):
+    """
+    Like ((x, draw(p, base, fmt)) for x,p,base in items), but with up to jobs
+    dot processes rendering at once, each given batch graphs. Results come
+    back in input order, each as soon as it (and those before it) are done;
+    x is passed through, and a None parse gets a None image.
+    With cachedir, images are instead stored there under the hash of their
+    DOT source, and only those not already in the cache are rendered.
+    """
+    running = deque()  # (x, DotBatch, index in the batch), or (x, None, image filename)
+    def finish():
+        x, b, i = running.popleft()
+        return x, (b.finish()[i] if b else i)
+
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, batch))
+        if not chunk: break
+        dots, imgfilenames, entries = [], [], []
+        for x,p,base in chunk:
+            if p is None:
+                entries.append((x, False, None))
+                continue
+            dot = psf2dot(p)+'\n'
+            if cachedir:
+                imgfilename = os.path.join(cachedir, hashlib.sha1(dot).hexdigest()+'.'+fmt)
+            else:
+                imgfilename = '{base}.{fmt}'.format(**locals())
+            if cachedir and os.path.exists(imgfilename):
+                entries.append((x, False, imgfilename))
+            elif cachedir and imgfilename in imgfilenames:  # the same graph again
+                entries.append((x, True, imgfilenames.index(imgfilename)))
+            else:
+                entries.append((x, True, len(dots)))
+                dots.append(dot)
+                imgfilenames.append(imgfilename)
+        b = DotBatch(dots, imgfilenames, fmt) if dots else None
+        running.extend((x, b if rendered else None, i) for x,rendered,i in entries)
+        while len({id(b) for x,b,i in running if b}) >= jobs:
+            yield finish()
+    while running:
+        yield finish()
 
 def desktop_open(filename):
     # TODO how does this work on other platforms
@@ -169,25 +287,71 @@ def desktop_open(filename):
         
 def process_potentially_multifile(filename):
     # parse container format and return GFL code .. do NOT parse it yet
-    with codecs.open(filename, 'r', 'utf-8') as inF:
-		anno_text = inF.read().strip()
-		if '%' not in anno_text:
-			tokens = string.letters
-			code = anno_text
-			return [(tokens, code, anno_text)]
-		anno_text = anno_text.replace('\r\n','\n')
-		multi_annos = re.split(r'(\n|^)--- *(\n|$)', anno_text)
-		multi_annos = ['---\n' + x.strip() for x in multi_annos if x.strip()]
-		if len(multi_annos) == 0:
-			print "empty annotations"
-			return None
-		tuples = []
-		for anno_text in multi_annos:
-			container = parse_parts(anno_text)
-			tokens = container.get('TEXT','').split()
-			code = container.get('ANNO','').strip()
-			tuples.append((tokens, code, anno_text))
-		return tuples
+    tuples = [(tokens, code, anno_text) for tokens,code,anno_text,lines in iter_containers(filename)]
+    if not tuples:
+        print "empty annotations"
+        return None
+    return tuples
+
+SEPARATOR = re.compile(r'--- *$')
+
+def iter_containers(filename):
+    """
+    Read an annotations file incrementally, yielding (tokens, code, anno_text,
+    (first line, last line)) for each container as soon as its closing ---
+    line has been read, where the line numbers (counting from 1) span the
+    container's text. A file without any % is one container of bare GFL
+    code, for which tokens are string.letters; it is only known to be one at
+    the end of the file, and is held in memory until then.
+    """
+    lines = []       # the current container's lines
+    first = None     # its first line number
+    pending = []     # finished containers, held until a % shows it is a container file
+    raw = []         # the whole file, while it might be bare GFL code
+    is_multi = False
+    at_start = True
+    lineno = 0
+    with open(filename, 'rb') as inF:  # (codecs would also split lines at other line breaks)
+        for lineno,line in enumerate(inF, 1):
+            # lines are only decoded once their container is complete
+            if not is_multi:
+                raw.append(line)
+                if '%' in line:
+                    is_multi = True
+                    raw = None
+            line = line.rstrip('\n')
+            if line.endswith('\r'): line = line[:-1]
+            if first is None and not line.strip():
+                continue
+            if at_start:
+                line = line.decode('utf-8').lstrip().encode('utf-8')  # as if the file had been stripped
+                at_start = False
+            if line.startswith('---') and SEPARATOR.match(line):
+                if lines: pending.append((lines, first))
+                lines, first = [], None
+            else:
+                if first is None: first = lineno
+                lines.append(line)
+            if is_multi:
+                for container in pending:
+                    yield make_container(*container)
+                pending = []
+    if lines: pending.append((lines, first))
+    if is_multi:
+        for container in pending:
+            yield make_container(*container)
+    else:
+        anno_text = ''.join(raw).decode('utf-8').strip()
+        yield string.letters, anno_text, anno_text, (1, lineno)
+
+def make_container(lines, first):
+    # trailing blank lines are not part of the container
+    while not lines[-1].strip(): lines.pop()
+    anno_text = u'---\n' + '\n'.join(lines).decode('utf-8').strip()
+    container = parse_parts(anno_text)
+    tokens = container.get('TEXT','').split()
+    code = container.get('ANNO','').strip()
+    return tokens, code, anno_text, (first, first+len(lines)-1)
 
 def is_json(s):
     try:
@@ -218,11 +382,19 @@ if __name__=='__main__':
     p.add_option('-n', dest="supress_open", action='store_true', help="force to not open image when done")
     p.add_option('-v', dest="verbose", action='store_true', help="verbose mode")
     p.add_option('-m', dest="open_html", action='store_true', help="force to open html, not png, version")
+    p.add_option('-c', dest="cache", help="directory for cached parses (see gfl_parser.ParseCache)")
+    p.add_option('-i', dest="imagecache", help="directory for rendered images, reused across runs (by default images are written next to the input)")
+    p.add_option('-j', dest="jobs", type='int', default=multiprocessing.cpu_count(), help="number of dot processes to run at once (default: number of CPUs)")
+    p.add_option('-b', dest="batch", type='int', default=1, help="number of graphs rendered by each dot process (default 1)")
+    p.add_option('-T', dest="format", choices=['png', 'svg'], default='png', help="image format: png (default) or svg")
     opts,args = p.parse_args()
     show_words = opts.show_words
     batch_mode = len(args) > 1
     do_open = not batch_mode and not opts.supress_open
     VERBOSE = opts.verbose
+    cache = gfl_parser.ParseCache(opts.cache) if opts.cache else None
+    if opts.imagecache and not os.path.isdir(opts.imagecache):
+        os.makedirs(opts.imagecache)
     multi_mode = None
     multi_annos = None
 
@@ -234,26 +406,26 @@ if __name__=='__main__':
     def parseiter(filename):
         if file_is_json(filename):  # JSON input
             assert filename != '/dev/stdin', "can't view JSON on stdin sorry!"
-            with codecs.open(filename, 'r', 'utf-8') as inF:
-				for i,line in enumerate(inF):
-					row = line.rstrip('\n').split('\t')
-					sentid = row[0]
-					obj = json.loads(row[-1])
+            for rec in fudg_json.records(filename, use_mmap=True):
+					if rec is None: continue
+					obj = rec.graph
 					parse = gfl_parser.Parse.from_json(obj)
 					anno_text = u' '.join(obj['tokens'])
 					yield anno_text,parse
         else:   # GFL annotation input
-            tokens_codes_texts = process_potentially_multifile(filename)
-            for tokens,code,text in tokens_codes_texts:
+            for tokens,code,text,lines in iter_containers(filename):
                 if not code or not tokens:
-                    parses.append(None)
+                    yield text,None
                 else:
                     try:
                         if not is_balanced(code):
                             raise Exception("Unbalanced parentheses, brackets, or braces in annotation:\n"+code)
                         if VERBOSE:
                             print 'Parsing: '+str(tokens)
-                        parse = gfl_parser.parse(tokens, code, check_semantics=True)
+                        if cache:
+                            parse = cache.parse(tokens, code, check_semantics=True)
+                        else:
+                            parse = gfl_parser.parse(tokens, code, check_semantics=True)
                         yield text,parse
                     except Exception:
                         print code
@@ -262,10 +434,8 @@ if __name__=='__main__':
                         yield text,None
 
     def make_images(filename, bigbase):
-        for i,(anno_text,parse) in enumerate(parseiter(filename)):
-            smallbase = '{}.{}'.format(bigbase,i)
-            imgfilename = draw(parse, smallbase)
-            yield anno_text,imgfilename
+        items = ((anno_text, parse, '{}.{}'.format(bigbase,i)) for i,(anno_text,parse) in enumerate(parseiter(filename)))
+        return draw_all(items, opts.jobs, opts.imagecache, opts.format, opts.batch)
 
     for filename in args:
         print "FILE",filename
@@ -277,16 +447,19 @@ if __name__=='__main__':
         
         #os.system("rm -f {bigbase}.*.png".format(**locals()))
         
-        inputAndImage = list(make_images(filename, bigbase))
-        # if processing massive amounts of data, this can be refactored so the parses are 
-        # processed one at a time and not stored in memory
+        # rows are written out as their images are rendered, so only the
+        # annotations still being rendered are held in memory
+        inputAndImage = make_images(filename, bigbase)
+        first = list(itertools.islice(inputAndImage, 2))
+        inputAndImage = itertools.chain(first, inputAndImage)
         
-        ashtml = (opts.open_html or len(inputAndImage)>1)
+        ashtml = (opts.open_html or len(first)>1)
         if ashtml:
             htmlfilename = bigbase + '.html'
             with codecs.open(htmlfilename, 'w', 'utf-8') as htmlF:
                 for anno_text,imgfilename in inputAndImage:
-                    print_html(htmlF, anno_text, imgfilename)
+                    print_html(htmlF, anno_text, imgfilename, os.path.dirname(htmlfilename) if opts.imagecache else None)
+                    htmlF.flush()
                 if do_open:
                     desktop_open(htmlfilename)
         else: